@@ -0,0 +1,259 @@
+"""
+Offline load benchmark for the try-on hot paths.
+
+Runs the real server code (TryOnCore) in this process over the Anvil server uplink,
+with the ModelsLab endpoints pointed at the local stub in modelslab_stub.py, so no
+modelslab.com credits are spent. For each concurrency level it drives
+    upload_image('user') -> upload_image('cloth') -> start_try_on -> check_try_on (until done)
+from that many threads and reports throughput, latency percentiles per call and
+peak traced memory. start_try_on is also given the iteration's images inline (an
+upload-cache hit by then), so concurrent iterations of the one bench user never pick
+up each other's latest uploads.
+
+    pip install anvil-uplink pillow requests httpx
+    ANVIL_UPLINK_KEY=server_... python bench/bench_try_on.py --levels 1,4,16 --iterations 8
+
+TryOnCore registers no server functions, so the live app's calls keep going to Anvil's
+servers. Still use the uplink key of a development copy of the app: the benchmark writes
+try_on_jobs, assets, cache, stored-result, metrics and rate-limit rows, all deleted again
+at the end (rows of --email, rows pointing at the stub, and the bench key's bucket).
+The dispatcher and poller run as threads in this process rather than as Anvil
+background tasks, so they also use the stub. The stub never calls the webhook, so the
+webhook grace period is set to 0 and jobs are polled as soon as their ETA passes.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import anvil.server
+import anvil.users
+import anvil.tables.query as q
+from anvil.tables import app_tables
+from PIL import Image
+
+from modelslab_stub import add_stub_arguments, parse_size, start_stub, stub_config_from_args
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PACKAGE = "vton_app"
+
+CALLS = ("upload_user", "upload_cloth", "start_try_on", "check_try_on", "end_to_end")
+
+
+def load_server_module():
+    """
+    Import the repo as a package (its __init__ maps server_code/ onto it) and return TryOnCore.
+    Not ServerModule1: importing that over the uplink would register every server function
+    in this process and route the live app's calls here.
+    """
+    spec = importlib.util.spec_from_file_location(
+        APP_PACKAGE, os.path.join(REPO_ROOT, "__init__.py"), submodule_search_locations=[REPO_ROOT]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[APP_PACKAGE] = package
+    spec.loader.exec_module(package)
+    return importlib.import_module(APP_PACKAGE + ".TryOnCore")
+
+
+def point_at_stub(server, base_url, rate_limited):
+    """Aim the server module at the stub and run its background tasks as local threads."""
+    server.API_URL = base_url + "/api/v6/image_editing/fashion"
+    server.CROP_API_URL = base_url + "/api/v3/base64_crop"
+    server.DELETE_API_URL = base_url + "/api/v3/delete_image"
+    # A separate key gives the bench its own rate-limit bucket and keeps the real key off the stub
+    server.API_KEY = "bench-key"
+    # No webhook will come from the stub: poll at the ETA instead of waiting out the grace period
+    server.WEBHOOK_GRACE_SECONDS = 0
+    if not rate_limited:
+        server.RATE_LIMIT_PER_MINUTE = 10 ** 6
+        server.RATE_LIMIT_BURST = 10 ** 6
+
+    threads = {}
+    lock = threading.Lock()
+
+    def ensure_task_running(task_name):
+        with lock:
+            thread = threads.get(task_name)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=getattr(server, task_name), daemon=True)
+                thread.start()
+                threads[task_name] = thread
+
+    server.ensure_task_running = ensure_task_running
+    server.ensure_poller_running = lambda: ensure_task_running('poll_pending_jobs')
+
+
+def make_image(size, seed):
+    """A PNG of 'size' whose bytes differ per seed, so the upload cache does not short-circuit."""
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    img.putpixel((0, 0), (seed % 256, (seed >> 8) % 256, (seed >> 16) % 256))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return anvil.BlobMedia("image/png", buf.getvalue(), name=f"bench-{seed}.png")
+
+
+def run_iteration(server, user_media, cloth_media, timeout):
+    """One full try-on. Returns {call: seconds} and the final status."""
+    timings = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    server.upload_image('user', user_media)
+    timings["upload_user"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    server.upload_image('cloth', cloth_media)
+    timings["upload_cloth"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    result = server.start_try_on(user_image=user_media, cloth_image=cloth_media)
+    timings["start_try_on"] = time.perf_counter() - t
+
+    checks = []
+    while result["status"] not in ("success", "failed"):
+        if time.perf_counter() - start > timeout:
+            result = {"status": "timeout"}
+            break
+        t = time.perf_counter()
+        status = server.check_try_on(result["job_id"], server.LONG_POLL_SECONDS)
+        checks.append(time.perf_counter() - t)
+        result = dict(status, job_id=result["job_id"])
+
+    timings["check_try_on"] = checks
+    timings["end_to_end"] = time.perf_counter() - start
+    return timings, result["status"]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def run_level(server, concurrency, iterations, image_size, reuse_images, timeout):
+    samples = {call: [] for call in CALLS}
+    statuses = {}
+    seeds = [0] * iterations if reuse_images else [random.randrange(1 << 30) for _ in range(iterations)]
+    media = [(make_image(image_size, seed), make_image(image_size, seed + 1)) for seed in seeds]
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_iteration, server, user, cloth, timeout) for user, cloth in media]
+        for future in futures:
+            try:
+                timings, status = future.result()
+            except Exception as e:
+                print(f"  iteration failed: {e}")
+                statuses["error"] = statuses.get("error", 0) + 1
+                continue
+            statuses[status] = statuses.get(status, 0) + 1
+            for call in CALLS:
+                value = timings[call]
+                samples[call].extend(value if isinstance(value, list) else [value])
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report = {
+        "concurrency": concurrency,
+        "iterations": iterations,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(statuses.get("success", 0) / elapsed, 3),
+        "statuses": statuses,
+        "peak_memory_mb": round(peak / (1024 * 1024), 2),
+        "latency_ms": {},
+    }
+    for call, values in samples.items():
+        values.sort()
+        report["latency_ms"][call] = {
+            f"p{pct}": round(1000 * percentile(values, pct), 1) for pct in (50, 95, 99)
+        }
+    return report
+
+
+def print_report(report):
+    print(f"concurrency {report['concurrency']}: {report['iterations']} try-ons in {report['elapsed_s']}s, "
+          f"{report['throughput_per_s']}/s, peak {report['peak_memory_mb']} MB, {report['statuses']}")
+    for call, stats in report["latency_ms"].items():
+        print(f"  {call:<14} p50 {stats['p50']:>9} ms  p95 {stats['p95']:>9} ms  p99 {stats['p99']:>9} ms")
+
+
+def cleanup_bench_rows(server, email, base_url, started):
+    """Delete every row the benchmark wrote."""
+    job_ids = [row['job_id'] for row in app_tables.try_on_jobs.search(user=email)]
+    for table in (app_tables.try_on_jobs, app_tables.assets):
+        for row in table.search(user=email):
+            row.delete()
+    stub_url = q.like(base_url + "%")
+    for row in app_tables.upload_cache.search(link=stub_url):
+        row.delete()
+    for row in app_tables.result_cache.search(result_url=stub_url):
+        row.delete()
+    # Through the server helper, so the result store's running size goes down too
+    server.delete_result_media(app_tables.result_media.search(result_url=stub_url))
+    for job_id in job_ids:
+        for row in app_tables.job_metrics.search(job_id=job_id):
+            row.delete()
+    # Upload spans have no job_id; the dev copy is assumed idle while the bench runs
+    for row in app_tables.job_metrics.search(job_id=None, recorded=q.greater_than_or_equal_to(started)):
+        row.delete()
+    for row in app_tables.rate_limits.search(name=server.rate_bucket_name()):
+        row.delete()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uplink-key", default=os.environ.get("ANVIL_UPLINK_KEY"))
+    parser.add_argument("--email", default="bench@example.com", help="user the benchmark logs in as")
+    parser.add_argument("--levels", default="1,2,4,8", help="comma-separated concurrency levels")
+    parser.add_argument("--iterations", type=int, default=8, help="try-ons per level")
+    parser.add_argument("--image-size", type=parse_size, default=(1024, 1365), help="WxH of uploaded images")
+    parser.add_argument("--reuse-images", action="store_true", help="upload identical images (cache hit path)")
+    parser.add_argument("--rate-limited", action="store_true", help="keep the app's upstream rate limit")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a try-on counts as timed out")
+    parser.add_argument("--json", dest="json_path", help="also write the reports to this file")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    if not args.uplink_key:
+        parser.error("a server uplink key is required (--uplink-key or ANVIL_UPLINK_KEY)")
+
+    stub, base_url = start_stub(stub_config_from_args(args))
+    print(f"ModelsLab stub on {base_url}")
+    anvil.server.connect(args.uplink_key)
+    server = load_server_module()
+    point_at_stub(server, base_url, args.rate_limited)
+
+    user = app_tables.users.get(email=args.email) or app_tables.users.add_row(email=args.email, enabled=True)
+    anvil.users.force_login(user)
+
+    reports = []
+    started = time.time()
+    try:
+        for level in [int(n) for n in args.levels.split(",")]:
+            report = run_level(server, level, args.iterations, args.image_size, args.reuse_images, args.timeout)
+            print_report(report)
+            reports.append(report)
+    finally:
+        cleanup_bench_rows(server, args.email, base_url, started)
+        stub.shutdown()
+        print(f"Stub request counts: {stub.state.counts}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"stub": vars(stub.state.config), "reports": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Local stand-in for the ModelsLab endpoints the app calls, for offline benchmarking.
+
+Serves:
+    POST /api/v3/base64_crop             -> {"status": "success", "link": <stub file url>}
+    POST /api/v6/image_editing/fashion   -> "processing" with an ETA (or an instant "success")
+    POST /fetch/<id>                     -> "processing" until the job's ETA has passed, then "success"
+    POST /api/v3/delete_image            -> {"status": "success"}
+    GET  /files/<name>                   -> a generated PNG of the configured output size
+
+Latency, ETA behaviour, error rate and image sizes are configurable. Run standalone with
+    python bench/modelslab_stub.py --port 8765 --latency-ms 200 --eta 3
+or start it in-process with StubConfig/start_stub (as bench_try_on.py does).
+"""
+
+import argparse
+import io
+import itertools
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+@dataclass
+class StubConfig:
+    latency_ms: float = 100       # added to every response
+    jitter_ms: float = 50         # uniform +/- jitter on top of latency_ms
+    eta: float = 3                # seconds a fashion job stays "processing"
+    reported_eta: float = None    # ETA reported to the app (defaults to eta)
+    instant_rate: float = 0.0     # fraction of fashion jobs that succeed immediately
+    error_rate: float = 0.0       # fraction of requests answered with a 503
+    output_size: tuple = (384, 512)
+
+
+class StubState:
+    """Jobs and counters shared by the handler threads."""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}            # job id -> time the job finishes
+        self.counts = {}
+        self._png = None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def output_png(self):
+        if self._png is None:
+            img = Image.new("RGB", self.config.output_size, (200, 180, 160))
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            self._png = buf.getvalue()
+        return self._png
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real API
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        """Read a Content-Length or chunked request body (the crop upload is streamed)."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def simulate_upstream(self):
+        """Apply latency and error injection. Returns False if an error was sent."""
+        config = self.state.config
+        delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+        time.sleep(max(0.0, delay) / 1000)
+        if random.random() < config.error_rate:
+            self.state.count("injected_errors")
+            self.send_json(503, {"status": "error", "message": "injected failure"})
+            return False
+        return True
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def do_POST(self):
+        body = self.read_body()
+        if not self.simulate_upstream():
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self.send_json(400, {"status": "error", "message": "invalid JSON body"})
+            return
+        if "key" not in payload:
+            self.send_json(401, {"status": "error", "message": "missing key"})
+            return
+
+        if self.path.endswith("/base64_crop"):
+            self.state.count("upload")
+            link = f"{self.base_url()}/files/upload-{next(self.state.ids)}.png"
+            self.send_json(200, {"status": "success", "link": link})
+        elif self.path.endswith("/image_editing/fashion"):
+            self.handle_fashion()
+        elif self.path.startswith("/fetch/"):
+            self.handle_fetch(self.path.rsplit("/", 1)[-1])
+        elif self.path.endswith("/delete_image"):
+            self.state.count("delete")
+            self.send_json(200, {"status": "success"})
+        else:
+            self.send_json(404, {"status": "error", "message": f"unknown endpoint {self.path}"})
+
+    def handle_fashion(self):
+        config = self.state.config
+        self.state.count("submit")
+        job_id = next(self.state.ids)
+        if random.random() < config.instant_rate:
+            self.send_json(200, self.success_body(job_id))
+            return
+        with self.state.lock:
+            self.state.jobs[str(job_id)] = time.time() + config.eta
+        self.send_json(200, {
+            "status": "processing",
+            "id": job_id,
+            "eta": config.reported_eta if config.reported_eta is not None else config.eta,
+            "fetch_result": f"{self.base_url()}/fetch/{job_id}",
+        })
+
+    def handle_fetch(self, job_id):
+        self.state.count("fetch")
+        with self.state.lock:
+            finishes = self.state.jobs.get(job_id)
+        if finishes is None:
+            self.send_json(200, {"status": "error", "message": "Request not found"})
+        elif time.time() < finishes:
+            self.send_json(200, {"status": "processing", "id": int(job_id), "eta": round(finishes - time.time())})
+        else:
+            self.send_json(200, self.success_body(job_id))
+
+    def success_body(self, job_id):
+        return {"status": "success", "id": int(job_id), "output": [f"{self.base_url()}/files/output-{job_id}.png"]}
+
+    def do_GET(self):
+        if not self.path.startswith("/files/"):
+            self.send_json(404, {"status": "error", "message": "not found"})
+            return
+        if not self.simulate_upstream():
+            return
+        self.state.count("download")
+        data = self.state.output_png()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(config, host="127.0.0.1", port=0):
+    """Start the stub on a daemon thread. Returns (server, base_url); stop with server.shutdown()."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--eta", type=float, default=3, help="seconds a job stays processing")
+    parser.add_argument("--reported-eta", type=float, default=None, help="ETA reported to the app (default: --eta)")
+    parser.add_argument("--instant-rate", type=float, default=0.0, help="fraction of jobs that succeed immediately")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--output-size", type=parse_size, default=(384, 512), help="WxH of result images")
+
+
+def stub_config_from_args(args):
+    return StubConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        eta=args.eta,
+        reported_eta=args.reported_eta,
+        instant_rate=args.instant_rate,
+        error_rate=args.error_rate,
+        output_size=args.output_size,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    server, base_url = start_stub(stub_config_from_args(args), args.host, args.port)
+    print(f"ModelsLab stub listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -17,9 +17,28 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.js
-import base64
 import time
 
+# Seconds the server may hold a check_try_on call open waiting for the webhook
+LONG_POLL_SECONDS = 20
+
+# Adaptive polling: the first check waits for the job's ETA, later checks (and retries
+# after connection errors) back off geometrically up to POLL_MAX_INTERVAL
+POLL_MIN_INTERVAL = 2
+POLL_BACKOFF = 2
+POLL_MAX_INTERVAL = 30
+POLL_MAX_FAILURES = 10
+
+# Batch gallery refresh interval (seconds)
+BATCH_POLL_INTERVAL = 5
+
+# Client-side compression (in a Web Worker): longest side in pixels and JPEG quality
+COMPRESS_MAX_DIMENSION = 600
+COMPRESS_QUALITY = 0.8
+
+# Wait this long after an image is picked so both images can go up in one upload_pair call
+UPLOAD_DEBOUNCE_SECONDS = 0.5
+
 class Form1(Form1Template):
     """
     Main form class that handles the virtual try-on interface and logic.
@@ -45,7 +64,8 @@ class Form1(Form1Template):
            # return
             
         self.init_components(**properties)
-        self.connection_retries = 0  # Initialize retry counter
+        self.connection_retries = 0  # Consecutive failed checks for the current job
+        self.poll_delay = POLL_MIN_INTERVAL
         
 
         
@@ -279,6 +299,11 @@ class Form1(Form1Template):
         self.image_result = Image(width=400, height=400, align="center")
         self.add_component(self.image_result)
 
+        # The poll result only carries a preview; the full image is fetched on request
+        self.full_size_button = Button(text="View full size", icon="fa:expand", visible=False)
+        self.full_size_button.set_event_handler('click', self.full_size_click)
+        self.add_component(self.full_size_button)
+
         # Add delete button next to result image
         self.delete_button = Button(
             text="Delete My Images",
@@ -289,17 +314,80 @@ class Form1(Form1Template):
         self.delete_button.set_event_handler('click', self.delete_images_click)
         self.column_panel_inputs.add_component(self.delete_button)
 
-        # Store media & fetch_url
+        # Batch try-on: the uploaded user photo against many garments at once
+        self.batch_header = Label(
+            text="👗 Try Many Garments",
+            font_size=16,
+            bold=True,
+            spacing_above="large",
+            spacing_below="small"
+        )
+        self.add_component(self.batch_header)
+
+        self.file_loader_batch = FileLoader(text="Upload Garment Photos", multiple=True)
+        self.add_component(self.file_loader_batch)
+
+        self.button_batch = Button(text="Try On All Garments", background="#2196F3", foreground="#FFFFFF")
+        self.button_batch.set_event_handler("click", self.button_batch_click)
+        self.add_component(self.button_batch)
+
+        self.label_batch_status = Label(text="", align="center", font_size=14)
+        self.add_component(self.label_batch_status)
+
+        # Gallery fills in as each garment's result arrives
+        self.gallery_panel = FlowPanel(align="center", spacing="small")
+        self.add_component(self.gallery_panel)
+
+        # One-shot timer that sends queued images to the server together
+        self.timer_upload = Timer(interval=UPLOAD_DEBOUNCE_SECONDS)
+        self.timer_upload.enabled = False
+        self.timer_upload.set_event_handler("tick", self.timer_upload_tick)
+        self.add_component(self.timer_upload)
+
+        self.timer_batch = Timer(interval=BATCH_POLL_INTERVAL)
+        self.timer_batch.enabled = False
+        self.timer_batch.set_event_handler("tick", self.timer_batch_tick)
+        self.add_component(self.timer_batch)
+
+        # Store media & job ids
         self.user_media = None
         self.cloth_media = None
-        self.fetch_url = None
+        self.job_id = None       # job currently being polled
+        self.last_job_id = None  # most recent finished job, for "Delete My Images"
+        self.batch_id = None
+        self.batch_images = {}  # batch index -> Image component in the gallery
+        self.pending_uploads = {}  # 'user'/'cloth' -> compressed media not yet sent to the server
+        self.upload_task = None  # background upload started by the timer, if any
+        self.uploading_media = {}  # 'user'/'cloth' -> media that upload_task is sending
+        self.server_assets = {}  # 'user'/'cloth' -> link of an earlier session's upload (start_try_on reuses them)
+        self.batch_garments = []  # compressed garment media (None until done) while a batch is being prepared
+        self.compressing = set()  # kinds whose compression is still running
+
+        self.show_latest_uploads()
 
         # Check for any pending jobs on startup/resume
-        stored_url = anvil.js.window.localStorage.getItem('pending_job_url')
-        if stored_url:
-            self.fetch_url = stored_url
+        stored_job_id = anvil.js.window.localStorage.getItem('pending_job_id')
+        if stored_job_id:
             self.label_status.text = "Processing..."
-            self.timer_poll.enabled = True
+            self.start_polling(stored_job_id, eta=0)
+        else:
+            self.restore_last_result()
+
+    def show_latest_uploads(self):
+        """Preview the user's most recent uploads (by link, so no image bytes pass through the server)."""
+        try:
+            latest = anvil.server.call_s('get_latest_user_images')
+        except Exception as e:
+            print(f"Could not load latest uploads: {e}")
+            return
+        if latest.get("user_url"):
+            self.image_user_preview.source = latest["user_url"]
+            self.image_user_preview.visible = True
+            self.server_assets['user'] = latest["user_url"]
+        if latest.get("cloth_url"):
+            self.image_cloth_preview.source = latest["cloth_url"]
+            self.image_cloth_preview.visible = True
+            self.server_assets['cloth'] = latest["cloth_url"]
 
     def setup_logout_button(self):
         current_user = anvil.users.get_user()
@@ -329,116 +417,116 @@ class Form1(Form1Template):
         """
         Compress the user image client-side.
         """
-        if not file:
-            return
-
-        file_loader_node = anvil.js.get_dom_node(self.file_loader_user)
-        js_file_input = file_loader_node.querySelector("input[type='file']")
-
-        if js_file_input and js_file_input.files and js_file_input.files.length > 0:
-            js_file_obj = js_file_input.files[0]
-            promise = anvil.js.call_js("compressImage", js_file_obj, 600)  # maxWidth=600
-
-            def on_success(data_url):
-                comma_idx = data_url.find(",")
-                if comma_idx < 0:
-                    alert("Invalid data URL after compression.")
-                    return
-
-                meta_part = data_url[:comma_idx]  # e.g. "data:image/jpeg;base64"
-                b64_data = data_url[comma_idx+1:]
-
-                if "image/png" in meta_part:
-                    content_type = "image/png"
-                else:
-                    content_type = "image/jpeg"
-
-                raw_bytes = base64.b64decode(b64_data)
-                compressed_media = BlobMedia(content_type, raw_bytes, name="compressed_user.jpg")
-
-                self.user_media = compressed_media
-                self.image_user_preview.source = compressed_media
-                self.image_user_preview.visible = True
-                print(f"Compressed user image size: {len(raw_bytes)} bytes")
-                try:
-                    # Start background upload
-                  anvil.server.call('start_background_upload', 'user', compressed_media)
-
-                  print("Uploading image in background ")
-
-                except Exception as e:
-                    print(f"Error uploading user image in background: {e}")
-
-
-            def on_error(err):
-                alert(f"Error compressing user image: {err}")
-
-            # Await the promise
-            try:
-                data_url = anvil.js.await_promise(promise)
-                on_success(data_url)
-            except Exception as e:
-                on_error(e)
-        else:
-            alert("Could not find the user file input. No file selected?")
+        if file:
+            self.compress_selected_file('user', self.file_loader_user)
 
     def file_loader_cloth_change(self, file, **event_args):
         """
         Compress the cloth image client-side.
         """
-        if not file:
-            return
-
-        file_loader_node = anvil.js.get_dom_node(self.file_loader_cloth)
-        js_file_input = file_loader_node.querySelector("input[type='file']")
-
-        if js_file_input and js_file_input.files and js_file_input.files.length > 0:
-            js_file_obj = js_file_input.files[0]
-            promise = anvil.js.call_js("compressImage", js_file_obj, 600)  # maxWidth=600
-
-            def on_success(data_url):
-                comma_idx = data_url.find(",")
-                if comma_idx < 0:
-                    alert("Invalid data URL after compression.")
-                    return
-
-                meta_part = data_url[:comma_idx]  # e.g. "data:image/jpeg;base64"
-                b64_data = data_url[comma_idx+1:]
-
-                if "image/png" in meta_part:
-                    content_type = "image/png"
-                else:
-                    content_type = "image/jpeg"
-
-                raw_bytes = base64.b64decode(b64_data)
-                compressed_media = BlobMedia(content_type, raw_bytes, name="compressed_cloth.jpg")
-
-                self.cloth_media = compressed_media
-                self.image_cloth_preview.source = compressed_media
-                self.image_cloth_preview.visible = True                
-                print(f"Compressed cloth image size: {len(raw_bytes)} bytes")
-                try:
-                    print("Uploading image in background ")
-
-                    # Start background upload  
-                    anvil.server.call('start_background_upload', 'user', compressed_media)
-
-
-                except Exception as e:
-                    print(f"Error uploading cloth image in background: {e}")
+        if file:
+            self.compress_selected_file('cloth', self.file_loader_cloth)
 
+    def compress_selected_file(self, kind, file_loader):
+        """
+        Start compressing the file picked in 'file_loader' in a Web Worker.
+        Returns straight away, so both images can be compressing at once;
+        compression_done picks up the result.
+        """
+        js_files = self.selected_js_files(file_loader)
+        if not js_files:
+            alert(f"Could not find the {kind} file input. No file selected?")
+            return
 
-            def on_error(err):
-                alert(f"Error compressing cloth image: {err}")
+        self.compressing.add(kind)
+        anvil.js.call_js(
+            "compressImage", js_files[0], COMPRESS_MAX_DIMENSION, COMPRESS_QUALITY,
+            lambda blob: self.compression_done(kind, blob),
+            lambda err: self.compression_failed(kind, err)
+        )
 
-            # Await the promise
-            try:
-                data_url = anvil.js.await_promise(promise)
-                on_success(data_url)
-            except Exception as e:
-                on_error(e)
+    def selected_js_files(self, file_loader):
+        """The browser File objects picked in 'file_loader' (a list, empty if none)."""
+        file_loader_node = anvil.js.get_dom_node(file_loader)
+        js_file_input = file_loader_node.querySelector("input[type='file']")
+        if not (js_file_input and js_file_input.files):
+            return []
+        return [js_file_input.files[i] for i in range(js_file_input.files.length)]
+
+    def compression_done(self, kind, blob):
+        """Turn the compressed JPEG Blob into Media (no base64 round trip), preview it and queue its upload."""
+        self.compressing.discard(kind)
+        compressed_media = anvil.js.to_media(blob, content_type="image/jpeg", name=f"compressed_{kind}.jpg")
+        if kind == 'user':
+            self.user_media = compressed_media
+            preview = self.image_user_preview
         else:
-            alert("Could not find the cloth file input. No file selected?")
+            self.cloth_media = compressed_media
+            preview = self.image_cloth_preview
+        preview.source = compressed_media
+        preview.visible = True
+        print(f"Compressed {kind} image size: {blob.size} bytes")
+        self.queue_upload(kind, compressed_media)
+
+    def compression_failed(self, kind, err):
+        self.compressing.discard(kind)
+        alert(f"Error compressing {kind} image: {err}")
+
+    def read_try_on_params(self):
+        """
+        Collect the generation settings from the inputs.
+        
+        Returns:
+            dict of prompt, negative_prompt, cloth_type, guidance_scale and num_steps,
+            or None (after alerting the user) if the guidance scale is invalid
+        """
+        try:
+            guidance_scale = float(self.text_box_guidance.text or "10")
+            if guidance_scale <= 0:
+                raise ValueError("Guidance scale must be positive")
+        except ValueError:
+            alert("Please enter a valid positive number for guidance scale")
+            return None
+        return {
+            "prompt": self.text_box_prompt.text,
+            "negative_prompt": self.text_box_negative_prompt.text,
+            "cloth_type": self.dropdown_cloth_type.selected_value,
+            "guidance_scale": guidance_scale,
+            "num_steps": int(self.dropdown_steps.selected_value),
+        }
+
+    def queue_upload(self, kind, media):
+        """Queue a compressed image for upload; images picked close together go up in one call."""
+        self.pending_uploads[kind] = media
+        self.timer_upload.enabled = False
+        self.timer_upload.enabled = True
+
+    def timer_upload_tick(self, **event_args):
+        """Upload every queued image in a single background upload_pair."""
+        self.timer_upload.enabled = False
+        pending, self.pending_uploads = self.pending_uploads, {}
+        if not pending:
+            return
+        # Media from an earlier upload that hasn't finished yet still counts as in flight
+        uploading = self.uploading_media if self.upload_in_flight() else {}
+        try:
+            self.upload_task = anvil.server.call('start_background_upload_pair', pending.get('user'), pending.get('cloth'))
+            self.uploading_media = dict(uploading, **pending)
+            print("Uploading images in background")
+        except Exception as e:
+            # Keep them for Start to send inline
+            self.pending_uploads = dict(pending, **self.pending_uploads)
+            print(f"Error uploading images in background: {e}")
+
+    def upload_in_flight(self):
+        """True if the last background upload has not (successfully) finished yet."""
+        if self.upload_task is None:
+            return False
+        try:
+            return self.upload_task.get_termination_status() != "completed"
+        except Exception as e:
+            print(f"Could not check background upload: {e}")
+            return True
 
     def button_start_click(self, **event_args):
         """
@@ -448,113 +536,286 @@ class Form1(Form1Template):
         Args:
             **event_args: Event arguments from Anvil
         """
-        # Validate image uploads
-        if not self.user_media or not self.cloth_media:
+        if self.compressing:
+            alert("Your images are still being prepared, please try again in a moment.")
+            return
+
+        # Validate image uploads: picked in this session, or the previews restored from the server
+        if not (self.user_media or 'user' in self.server_assets) or not (self.cloth_media or 'cloth' in self.server_assets):
             alert("Please upload both user and cloth images first.")
             return
         
         # Get all input values
-        cloth_type = self.dropdown_cloth_type.selected_value
-        user_prompt = self.text_box_prompt.text
-        negative_prompt = self.text_box_negative_prompt.text
-        num_steps = int(self.dropdown_steps.selected_value)
-        
-        try:
-            guidance_scale = float(self.text_box_guidance.text or "10")
-            if guidance_scale <= 0:
-                raise ValueError("Guidance scale must be positive")
-        except ValueError:
-            alert("Please enter a valid positive number for guidance scale")
+        params = self.read_try_on_params()
+        if params is None:
             return
         
+        # Disabled until the job finishes, so a double click can't submit it twice
+        self.button_start.enabled = False
+
+        # Images still waiting for the upload timer, or whose background upload hasn't
+        # finished, go up inline with the job so the server can't use an older upload
+        self.timer_upload.enabled = False
+        pending, self.pending_uploads = self.pending_uploads, {}
+        if self.upload_in_flight():
+            pending = dict(self.uploading_media, **pending)
+
         # Pass all parameters to server
-        result = anvil.server.call('start_try_on', 
-                                 user_prompt,
-                                 cloth_type,
-                                 guidance_scale,
-                                 num_steps,
-                                 negative_prompt)
+        try:
+            result = anvil.server.call('start_try_on', 
+                                     params["prompt"],
+                                     params["cloth_type"],
+                                     params["guidance_scale"],
+                                     params["num_steps"],
+                                     params["negative_prompt"],
+                                     user_image=pending.get('user'),
+                                     cloth_image=pending.get('cloth'))
+        except Exception as e:
+            # Keep the images for the next attempt (newer picks made meanwhile win), so it
+            # can't fall back to an older upload on the server
+            self.pending_uploads = dict(pending, **self.pending_uploads)
+            self.button_start.enabled = True
+            alert(f"Error submitting job: {e}")
+            return
         
         # Clear old result
         self.image_result.source = None
+        self.full_size_button.visible = False
         self.label_status.text = "Submitting job..."
-        self.fetch_url = None
+        self.job_id = None
 
         try:
             if result["status"] == "success":
-                self.image_result.source = result["image"]
-                self.label_status.text = "Done!"
+                self.show_result(result["job_id"], result["preview"])
                 self.button_start.enabled = True
-                self.delete_button.visible = True
-                print(f"Success request_id: {result.get('request_id')}")  # Debug: Check request_id on success
+                print(f"Success job_id: {result.get('job_id')}")  # Debug: Check job_id on success
+            elif result["status"] == "queued":
+                self.label_status.text = f"Queued (position {result['position']})... ETA ~{result['eta']} seconds."
+                self.start_polling(result["job_id"], result.get("start_in", 0))
+                print(f"Queued job_id: {result.get('job_id')}")
             else:
-                self.fetch_url = result["fetch_url"]
                 eta = result.get("eta", 10)
                 self.label_status.text = f"Submitted job, still processing... ETA ~{eta} seconds."
-                self.timer_poll.enabled = True
-                print(f"Processing request_id: {result.get('request_id')}")  # Debug: Check request_id while processing
+                self.start_polling(result["job_id"], eta)
+                print(f"Processing job_id: {result.get('job_id')}")  # Debug: Check job_id while processing
         except Exception as e:
             alert(f"Error submitting job: {e}")
             self.label_status.text = "Error"
+            self.button_start.enabled = True
 
         # Add just this one line to scroll to bottom
         anvil.js.window.scrollTo(0, anvil.js.window.document.body.scrollHeight)
 
+    def show_result(self, job_id, preview):
+        """Show a finished job's preview and offer the full-size image."""
+        self.image_result.source = preview
+        self.label_status.text = "Done!"
+        self.delete_button.visible = True
+        self.full_size_button.visible = True
+        self.last_job_id = job_id
+        anvil.js.window.localStorage.setItem('last_job_id', job_id)
+
+    def restore_last_result(self):
+        """After a reload, show the last finished result again (served from the server's result store)."""
+        job_id = anvil.js.window.localStorage.getItem('last_job_id')
+        if not job_id:
+            return
+        try:
+            result = anvil.server.call_s('check_try_on', job_id)
+        except Exception as e:
+            print(f"Could not restore last result: {e}")
+            return
+        if result["status"] == "success":
+            self.show_result(job_id, result["preview"])
+        else:
+            anvil.js.window.localStorage.removeItem('last_job_id')
+
+    def full_size_click(self, **event_args):
+        """Swap the preview for the full-resolution result."""
+        if not self.last_job_id:
+            return
+        try:
+            self.image_result.source = anvil.server.call('get_full_result', self.last_job_id)
+            self.full_size_button.visible = False
+        except Exception as e:
+            alert(f"Could not load the full image: {e}")
+
+    def start_polling(self, job_id, eta):
+        """
+        Begin checking a submitted job: nothing is sent until its ETA has passed.
+        
+        Args:
+            job_id: The job id returned by start_try_on
+            eta: Seconds until the job is expected to finish
+        """
+        self.job_id = job_id
+        anvil.js.window.localStorage.setItem('pending_job_id', job_id)
+        self.connection_retries = 0
+        self.poll_delay = POLL_MIN_INTERVAL
+        self.schedule_poll(eta)
+
+    def schedule_poll(self, delay):
+        """Arm the poll timer to fire once after 'delay' seconds."""
+        self.timer_poll.interval = max(POLL_MIN_INTERVAL, min(delay, POLL_MAX_INTERVAL))
+        self.timer_poll.enabled = True
+
+    def schedule_backoff_poll(self):
+        """Schedule the next check one backoff step later than the previous one."""
+        self.schedule_poll(self.poll_delay)
+        self.poll_delay = min(self.poll_delay * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+    def stop_polling(self):
+        self.timer_poll.enabled = False
+        self.button_start.enabled = True
+        anvil.js.window.localStorage.removeItem('pending_job_id')
+        self.job_id = None
+
     def timer_poll_tick(self, **event_args):
         """
         Poll for job completion status.
         Handles success, failure, and updates UI accordingly.
+        Each tick is one-shot; the next one is scheduled by the backoff policy.
         Manages background state persistence.
         
         Args:
             **event_args: Event arguments from Anvil
         """
-        if not self.fetch_url:
+        if not self.job_id:
             self.timer_poll.enabled = False
             return
 
         self.label_status.text = "Checking status..."
+        # One-shot: the next tick is armed below once this check has returned
+        self.timer_poll.enabled = False
         try:
-            check_result = anvil.server.call('check_try_on', self.fetch_url)
+            check_result = anvil.server.call_s('check_try_on', self.job_id, LONG_POLL_SECONDS)
             print(f"Poll result: {check_result}")  # Debug: Print poll result
-            print(f"Poll request_id: {check_result.get('request_id')}")  # Debug: Check request_id from poll
             self.connection_retries = 0  # Reset counter on successful connection
             
             if check_result["status"] == "success":
-                self.image_result.source = check_result["image"]
-                self.label_status.text = "Done!"
-                self.delete_button.visible = True
-                self.timer_poll.enabled = False
-                self.button_start.enabled = True
-                anvil.js.window.localStorage.removeItem('pending_job_url')
-                self.fetch_url = None
+                self.show_result(self.job_id, check_result["preview"])
+                self.stop_polling()
+            elif check_result["status"] == "queued":
+                self.label_status.text = (f"Queued (position {check_result['position']})... "
+                                          f"starting in ~{check_result['start_in']}s")
+                self.schedule_backoff_poll()
             elif check_result["status"] == "processing":
                 eta = check_result.get("eta", 10)
-                self.label_status.text = f"Still processing... Next check in 3s. (ETA ~{eta}s)"
+                self.label_status.text = f"Still processing... (ETA ~{eta}s)"
+                self.schedule_backoff_poll()
             elif check_result["status"] == "failed":
                 self.label_status.text = "Failed: " + check_result.get("error", "Unknown error")
-                self.timer_poll.enabled = False
-                self.button_start.enabled = True
-                anvil.js.window.localStorage.removeItem('pending_job_url')
-                self.fetch_url = None
+                self.stop_polling()
             else:
                 alert(f"Unexpected status: {check_result}")
                 self.label_status.text = "Error"
-                self.timer_poll.enabled = False
-                self.button_start.enabled = True
-                anvil.js.window.localStorage.removeItem('pending_job_url')
-                self.fetch_url = None
+                self.stop_polling()
         except Exception as e:
             self.connection_retries += 1
-            if self.connection_retries >= 10:  # Stop after 10 failures
+            if self.connection_retries >= POLL_MAX_FAILURES:
                 self.label_status.text = "Connection failed. Please try again."
-                self.timer_poll.enabled = False
-                self.button_start.enabled = True
-                anvil.js.window.localStorage.removeItem('pending_job_url')
-                self.fetch_url = None
+                self.stop_polling()
             else:
-                self.label_status.text = f"Checking status... (Attempt {self.connection_retries}/10)"
+                self.label_status.text = f"Checking status... (Attempt {self.connection_retries}/{POLL_MAX_FAILURES})"
                 print(f"Error polling job status: {str(e)}")
+                self.schedule_backoff_poll()
+
+    def button_batch_click(self, **event_args):
+        """Start a batch try-on of the user photo against every selected garment."""
+        model_ref = self.user_media or self.server_assets.get('user')
+        if not model_ref:
+            alert("Please upload your photo first.")
+            return
+        garments = self.selected_js_files(self.file_loader_batch)
+        if not garments:
+            alert("Please select one or more garment photos.")
+            return
+        params = self.read_try_on_params()
+        if params is None:
+            return
+
+        self.button_batch.enabled = False
+        self.gallery_panel.clear()
+        self.batch_images = {}
+        self.label_batch_status.text = f"Preparing {len(garments)} garment photos..."
+        # Compress every garment like the single loaders do; the batch is sent once all are done
+        self.batch_garments = [None] * len(garments)
+        for index, js_file in enumerate(garments):
+            anvil.js.call_js(
+                "compressImage", js_file, COMPRESS_MAX_DIMENSION, COMPRESS_QUALITY,
+                lambda blob, index=index: self.batch_garment_done(index, blob, model_ref, params),
+                lambda err, index=index: self.batch_garment_failed(index, err)
+            )
+
+    def batch_garment_done(self, index, blob, model_ref, params):
+        """Store one compressed garment; submit the batch when it was the last one."""
+        if not self.batch_garments:
+            return  # an earlier garment failed and the batch was abandoned
+        self.batch_garments[index] = anvil.js.to_media(blob, content_type="image/jpeg",
+                                                       name=f"compressed_garment_{index}.jpg")
+        if all(media is not None for media in self.batch_garments):
+            garments, self.batch_garments = self.batch_garments, []
+            self.submit_batch(model_ref, garments, params)
+
+    def batch_garment_failed(self, index, err):
+        if not self.batch_garments:
+            return
+        self.batch_garments = []
+        alert(f"Error compressing garment {index + 1}: {err}")
+        self.label_batch_status.text = "Error"
+        self.button_batch.enabled = True
+
+    def submit_batch(self, model_ref, garments, params):
+        """Send the compressed garments to start_try_on_batch and set up the gallery."""
+        self.label_batch_status.text = f"Submitting {len(garments)} try-ons..."
+        try:
+            result = anvil.server.call('start_try_on_batch', model_ref, garments, params)
+        except Exception as e:
+            alert(f"Error submitting batch: {e}")
+            self.label_batch_status.text = "Error"
+            self.button_batch.enabled = True
+            return
+
+        self.batch_id = result["batch_id"]
+        # One placeholder per garment, filled in as results arrive
+        for index in range(result["total"]):
+            placeholder = Image(width=180, height=240, display_mode="zoom_to_fill", tooltip="Processing...")
+            self.batch_images[index] = placeholder
+            self.gallery_panel.add_component(placeholder)
+        self.timer_batch_tick()
+
+    def timer_batch_tick(self, **event_args):
+        """Fetch batch progress and drop newly finished results into the gallery."""
+        self.timer_batch.enabled = False
+        if not self.batch_id:
+            return
+        have = [index for index, image in self.batch_images.items() if image.source is not None]
+        try:
+            status = anvil.server.call_s('get_batch_status', self.batch_id, have)
+        except Exception as e:
+            print(f"Error polling batch status: {e}")
+            self.timer_batch.enabled = True
+            return
+
+        items = {item["index"]: item for item in status["items"]}
+        for item in status["items"]:
+            image = self.batch_images.get(item["index"])
+            if image is None:
+                continue
+            if "preview" in item:
+                image.source = item["preview"]
+                image.tooltip = ""
+            elif item["status"] == "failed":
+                image.tooltip = "Failed: " + item.get("error", "Unknown error")
+
+        self.label_batch_status.text = f"{status['done']} of {status['total']} done, {status['failed']} failed"
+        all_shown = all(image.source is not None for index, image in self.batch_images.items()
+                        if index in items and items[index]["status"] == "success")
+        if status["complete"] and all_shown:
+            self.batch_id = None
+            self.button_batch.enabled = True
+        else:
+            self.timer_batch.enabled = True
 
     def advanced_toggle_click(self, **event_args):
         """Toggle visibility of advanced options"""
@@ -566,22 +827,22 @@ class Form1(Form1Template):
         try:
             print("Starting delete process...")  # Debug
             
-            # Get the request_id from the database
-            job = app_tables.try_on_jobs.get(
-                created=q.maximum()  # Get most recent job
-            )
-            print(f"Found job: {job}")  # Debug
-            
-            request_id = job["request_id"]
-            print(f"Request ID to delete: {request_id}")  # Debug
+            # The most recent finished job on this page
+            job_id = self.last_job_id
+            print(f"Job ID to delete: {job_id}")  # Debug
+            if not job_id:
+                return
             
             # Call server to delete images
-            result = anvil.server.call('delete_images_now', request_id)
+            result = anvil.server.call('delete_images_now', job_id)
             print(f"Delete API result: {result}")  # Debug
             
             # Clear the result image
             self.image_result.source = None
             self.delete_button.visible = False
+            self.full_size_button.visible = False
+            self.last_job_id = None
+            anvil.js.window.localStorage.removeItem('last_job_id')
             alert("Your images have been deleted.")
         except Exception as e:
             print(f"Delete error details: {str(e)}")  # Debug
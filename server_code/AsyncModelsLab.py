@@ -0,0 +1,215 @@
+"""
+asyncio variant of the ModelsLab client, for fanning out many requests at once.
+
+AsyncModelsLabClient offers the same operations as the sync server code (upload/crop,
+submit fashion job, fetch result, download output, delete image) on an httpx.AsyncClient,
+so a background task can run many of them concurrently on one thread. Each operation has
+its own semaphore, which caps how many requests to that endpoint are in flight. Retry policy,
+timeouts, pool size and latency counters are shared with ModelsLabClient.
+"""
+
+import asyncio
+import time
+
+import httpx
+
+from . import ModelsLabClient
+
+# Default max in-flight requests per operation
+ENDPOINT_CONCURRENCY = {
+    "upload": 4,
+    "submit": 4,
+    "fetch": 8,
+    "download": 8,
+    "delete": 8,
+}
+
+
+# Failures before the request was sent (no connection could be made)
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _read_all(resp):
+    await resp.aread()
+    return resp
+
+
+class AsyncModelsLabClient:
+    """
+    Async ModelsLab client. Use as an async context manager so the connection
+    pool is closed when done:
+
+        async with AsyncModelsLabClient(API_KEY, CROP_API_URL, API_URL, DELETE_API_URL) as client:
+            results = await client.gather(client.fetch(url) for url in urls)
+    """
+
+    def __init__(self, api_key, crop_url, fashion_url, delete_url, concurrency=None):
+        self.api_key = api_key
+        self.crop_url = crop_url
+        self.fashion_url = fashion_url
+        self.delete_url = delete_url
+        limits = dict(ENDPOINT_CONCURRENCY, **(concurrency or {}))
+        self._semaphores = {op: asyncio.Semaphore(n) for op, n in limits.items()}
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ModelsLabClient.POOL_MAXSIZE,
+                max_keepalive_connections=ModelsLabClient.POOL_MAXSIZE,
+            ),
+            timeout=httpx.Timeout(ModelsLabClient.READ_TIMEOUT, connect=ModelsLabClient.CONNECT_TIMEOUT),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _request(self, op, method, url, body_factory=None, retries=ModelsLabClient.MAX_RETRIES,
+                       reader=None, idempotent=True, **kwargs):
+        """
+        Send one request under the semaphore for 'op', retrying 429/5xx and transport errors.
+        Returns the response, or with 'reader' returns await reader(resp) on the streamed
+        response, so errors while reading the body are retried too. With idempotent=False
+        only failed connects and 429s are retried (see NON_IDEMPOTENT_RETRY_STATUSES).
+        """
+        endpoint = op
+        if idempotent:
+            retry_statuses, retry_errors = ModelsLabClient.RETRY_STATUSES, httpx.TransportError
+        else:
+            retry_statuses, retry_errors = ModelsLabClient.NON_IDEMPOTENT_RETRY_STATUSES, CONNECT_ERRORS
+        attempt = 0
+        async with self._semaphores[op]:
+            while True:
+                if body_factory is not None:
+                    kwargs["content"] = _aiter(body_factory())
+                start = time.perf_counter()
+                try:
+                    resp = await self._client.send(self._client.build_request(method, url, **kwargs), stream=True)
+                    try:
+                        ok = resp.status_code not in retry_statuses
+                        if ok or attempt >= retries:
+                            result = await (reader or _read_all)(resp)
+                    finally:
+                        await resp.aclose()
+                except retry_errors as e:
+                    ModelsLabClient.record_latency(endpoint, time.perf_counter() - start, False)
+                    if attempt >= retries:
+                        raise
+                    delay = ModelsLabClient.backoff_delay(attempt)
+                    print(f"{method} {endpoint} failed ({e}), retrying in {delay:.1f}s")
+                except Exception:
+                    ModelsLabClient.record_latency(endpoint, time.perf_counter() - start, False)
+                    raise
+                else:
+                    ModelsLabClient.record_latency(endpoint, time.perf_counter() - start,
+                                                   resp.status_code not in ModelsLabClient.RETRY_STATUSES)
+                    if ok or attempt >= retries:
+                        return result
+                    delay = ModelsLabClient.backoff_delay(attempt, resp.headers.get("Retry-After"))
+                    print(f"{method} {endpoint} returned {resp.status_code}, retrying in {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _post_json(self, op, url, payload, idempotent=True):
+        resp = await self._request(op, "POST", url, json=payload, idempotent=idempotent)
+        if resp.status_code != 200:
+            raise Exception(f"{op} failed ({resp.status_code}): {resp.text}")
+        return resp.json()
+
+    async def upload(self, image_bytes, content_type):
+        """Upload image bytes to the crop endpoint (streamed body) and return the link."""
+        resp = await self._request(
+            "upload", "POST", self.crop_url,
+            headers={"Content-Type": "application/json"},
+            body_factory=lambda: ModelsLabClient.iter_crop_payload(self.api_key, image_bytes, content_type),
+        )
+        if resp.status_code != 200:
+            raise Exception(f"Failed upload_to_sd: {resp.text}")
+        data = resp.json()
+        if "link" not in data:
+            raise Exception(f"Unexpected response: {data}")
+        return data["link"]
+
+    async def submit(self, payload):
+        """Submit a fashion job; 'payload' is the full request body including the key."""
+        return await self._post_json("submit", self.fashion_url, payload, idempotent=False)
+
+    async def fetch(self, fetch_url):
+        """Check a job's fetch_result URL once."""
+        return await self._post_json("fetch", fetch_url, {"key": self.api_key})
+
+    async def download(self, image_url, max_bytes):
+        """Download an output image. Returns (bytes, content_type header)."""
+        async def read(resp):
+            if resp.status_code != 200:
+                raise Exception(f"Failed to download image. Status: {resp.status_code}")
+            chunks, size = [], 0
+            async for chunk in resp.aiter_bytes():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise Exception(f"Downloaded image exceeds {max_bytes} bytes")
+                chunks.append(chunk)
+            return b"".join(chunks), resp.headers.get("Content-Type", "")
+        return await self._request("download", "GET", image_url, reader=read)
+
+    async def delete(self, request_id):
+        """Delete a finished job's images upstream."""
+        return await self._post_json("delete", self.delete_url, {"key": self.api_key, "request_id": request_id})
+
+    async def gather(self, coros):
+        """Await many operations concurrently; failures are returned as exception objects."""
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+
+class Runner:
+    """
+    An event loop and AsyncModelsLabClient kept open across many run() calls, so a
+    long-running background task reuses one connection pool instead of building a
+    new loop and client every tick:
+
+        with Runner(client_kwargs) as runner:
+            while True:
+                results = runner.run(lambda client: client.gather(...))
+    """
+
+    def __init__(self, client_kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._client = self._loop.run_until_complete(self._open(client_kwargs))
+
+    async def _open(self, client_kwargs):
+        # Created inside the loop so its semaphores belong to it
+        return AsyncModelsLabClient(**client_kwargs)
+
+    def run(self, operation):
+        """Run 'operation(client)' to completion on this runner's loop."""
+        return self._loop.run_until_complete(operation(self._client))
+
+    def close(self):
+        try:
+            self._loop.run_until_complete(self._client.aclose())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        finally:
+            self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run(client_kwargs, operation):
+    """
+    Run 'operation(client)' to completion from synchronous code (callables, background
+    tasks) on a fresh event loop with its own AsyncModelsLabClient.
+    """
+    with Runner(client_kwargs) as runner:
+        return runner.run(operation)
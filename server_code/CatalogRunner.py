@@ -0,0 +1,264 @@
+"""
+Headless try-on runner for whole garment catalogs.
+
+A manifest is a CSV (or a list of dicts) with one try-on per row:
+
+    id,model_image,garment_image,cloth_type,prompt,negative_prompt,guidance_scale,num_steps
+    sku-001,models/anna.jpg,garments/sku-001.jpg,dresses,,,,
+    sku-002,https://.../anna.png,https://.../sku-002.png,upper_body,studio light,,8,30
+
+Only model_image and garment_image are required. Each is either an http(s) URL, which is
+passed to ModelsLab as-is, or a local file path (uplink scripts only), which is uploaded
+through the usual upload cache. Each row goes through upload -> fashion API -> fetch ->
+download on a bounded worker pool. Progress is checkpointed per row in catalog_rows, so
+calling the runner again with the same run_id skips finished rows and retries failed ones.
+Outputs are written to a local directory, or to the catalog_rows.output Media column.
+
+From an uplink script:
+
+    from VTON import CatalogRunner
+    CatalogRunner.run_manifest("catalog.csv", run_id="spring", output_dir="out/")
+
+From the app: start_catalog_run(manifest_media) launches the run_catalog background task.
+"""
+
+import anvil.server
+from anvil.tables import app_tables
+import anvil
+import csv
+import hashlib
+import io
+import mimetypes
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from . import ModelsLabClient
+from . import TryOnCore
+
+# Try-ons running at once (each worker submits, polls and downloads one row)
+CATALOG_MAX_WORKERS = 4
+# Attempts per row before it is recorded as failed; retries back off like HTTP retries
+CATALOG_MAX_ATTEMPTS = 3
+# Give up on a single upstream job after this long
+CATALOG_JOB_TIMEOUT = 600
+# Print a progress line every this many finished rows
+CATALOG_PROGRESS_EVERY = 25
+
+
+def read_manifest(manifest):
+    """Manifest rows as dicts, from a CSV path, CSV text, a Media object or a list of dicts."""
+    if isinstance(manifest, list):
+        return manifest
+    if isinstance(manifest, str) and os.path.exists(manifest):
+        with open(manifest, newline="") as f:
+            return list(csv.DictReader(f))
+    if not isinstance(manifest, str):
+        manifest = manifest.get_bytes().decode("utf-8-sig")
+    return list(csv.DictReader(io.StringIO(manifest)))
+
+
+def row_key(index, entry):
+    """Stable id for a manifest row: its 'id' column, else a hash of its contents."""
+    if entry.get("id"):
+        return str(entry["id"])
+    content = "|".join(f"{k}={entry[k]}" for k in sorted(entry))
+    return f"{index}-" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+
+
+def is_url(ref):
+    return ref.startswith("http://") or ref.startswith("https://")
+
+
+def file_media(path):
+    content_type = mimetypes.guess_type(path)[0] or "image/jpeg"
+    with open(path, "rb") as f:
+        return anvil.BlobMedia(content_type, f.read(), name=os.path.basename(path))
+
+
+def resolve_image_urls(entries):
+    """Upload every distinct local image referenced by 'entries' once. Returns {ref: url}."""
+    refs = []
+    for entry in entries:
+        for ref in (entry["model_image"], entry["garment_image"]):
+            if not is_url(ref) and ref not in refs:
+                refs.append(ref)
+    urls = {}
+    if refs:
+        links = TryOnCore.upload_many([file_media(ref) for ref in refs])
+        urls = dict(zip(refs, links))
+    return lambda ref: ref if is_url(ref) else urls[ref]
+
+
+def build_payload(entry, url_for):
+    """Fashion API body for a manifest row (no webhook: catalog jobs are polled directly)."""
+    payload = TryOnCore.build_fashion_payload(
+        url_for(entry["model_image"]),
+        url_for(entry["garment_image"]),
+        entry.get("cloth_type") or "dresses",
+        entry.get("prompt") or "",
+        entry.get("negative_prompt") or "",
+        float(entry.get("guidance_scale") or 10.0),
+        int(entry.get("num_steps") or 21),
+        uuid.uuid4().hex
+    )
+    del payload["webhook"]
+    return payload
+
+
+def run_catalog_job(payload):
+    """
+    Submit one try-on, wait for it and download the output.
+    Returns (request_id, result_url, image bytes, content type header). Makes no table
+    calls, so it is safe to run on worker threads.
+    """
+    resp = ModelsLabClient.post_json(TryOnCore.API_URL, payload, op="submit", idempotent=False)
+    if resp.status_code != 200:
+        raise Exception(f"Failed to start job: {resp.text}")
+    data = resp.json()
+    fetch_url = data.get("fetch_result")
+    deadline = time.time() + CATALOG_JOB_TIMEOUT
+    while data.get("status") == "processing":
+        if time.time() > deadline:
+            raise Exception(f"Job {data.get('id')} still processing after {CATALOG_JOB_TIMEOUT}s")
+        wait_s = min(max(data.get("eta", 10), TryOnCore.POLL_MIN_INTERVAL), TryOnCore.POLL_MAX_INTERVAL)
+        time.sleep(wait_s)
+        resp = ModelsLabClient.post_json(fetch_url, {"key": TryOnCore.API_KEY}, op="fetch")
+        if resp.status_code != 200:
+            raise Exception(f"Failed to check job: {resp.text}")
+        data = resp.json()
+    if data.get("status") != "success":
+        raise Exception(f"Job failed: {data.get('message') or data}")
+    result_url = TryOnCore.extract_result_url(data)
+    if not result_url:
+        raise Exception("No final image link found in success response!")
+    raw, header_type = TryOnCore.download_image(result_url)
+    request_id = str(data["id"]) if data.get("id") is not None else None
+    return request_id, result_url, bytes(raw), header_type
+
+
+def save_output(checkpoint, key, media, output_dir):
+    """Write a finished output to 'output_dir' if given, otherwise to the checkpoint row."""
+    if output_dir:
+        extension = TryOnCore.CONTENT_TYPE_EXTENSIONS[media.content_type]
+        with open(os.path.join(output_dir, f"{key}.{extension}"), "wb") as f:
+            f.write(media.get_bytes())
+    else:
+        checkpoint['output'] = media
+
+
+def run_manifest(manifest, run_id=None, output_dir=None, max_workers=CATALOG_MAX_WORKERS):
+    """
+    Run every try-on in 'manifest' and return a throughput summary.
+    Rows already finished under 'run_id' are skipped, so an interrupted run resumes where it stopped.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    checkpoints = {row['row_key']: row for row in app_tables.catalog_rows.search(run_id=run_id)}
+    todo = deque()
+    skipped = 0
+    for index, entry in enumerate(read_manifest(manifest)):
+        key = row_key(index, entry)
+        checkpoint = checkpoints.get(key)
+        if checkpoint is not None and checkpoint['status'] == "done":
+            skipped += 1
+            continue
+        if checkpoint is None:
+            checkpoint = app_tables.catalog_rows.add_row(run_id=run_id, row_key=key, status="pending", attempts=0)
+        else:
+            # Rows that failed or were cut off last time get a fresh set of attempts
+            checkpoint.update(status="pending", attempts=0)
+        todo.append((key, entry, checkpoint, 0.0))
+    print(f"Catalog {run_id}: {len(todo)} rows to run, {skipped} already done")
+
+    url_for = resolve_image_urls([entry for _, entry, _, _ in todo])
+    started = time.time()
+    done = failed = 0
+    row_seconds = []
+    running = {}
+    # Submissions, retries and table writes happen on this thread; workers only do HTTP
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while todo or running:
+            # Running rows (this run's included) count toward the app-wide in-flight cap
+            slots = 0
+            if todo and len(running) < max_workers and todo[0][3] <= time.time():
+                slots = TryOnCore.MAX_IN_FLIGHT_JOBS - TryOnCore.count_in_flight()
+            while todo and slots > 0 and len(running) < max_workers and todo[0][3] <= time.time():
+                if TryOnCore.take_rate_tokens(TryOnCore.rate_bucket_name(), 1) < 1:
+                    break
+                slots -= 1
+                key, entry, checkpoint, _ = todo.popleft()
+                checkpoint.update(status="running", attempts=(checkpoint['attempts'] or 0) + 1, updated=datetime.now())
+                future = pool.submit(run_catalog_job, build_payload(entry, url_for))
+                running[future] = (key, entry, checkpoint, time.time())
+
+            if not running:
+                time.sleep(1)
+                continue
+            finished, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key, entry, checkpoint, submitted = running.pop(future)
+                try:
+                    request_id, result_url, data, header_type = future.result()
+                except Exception as e:
+                    if checkpoint['attempts'] < CATALOG_MAX_ATTEMPTS:
+                        delay = ModelsLabClient.backoff_delay(checkpoint['attempts'])
+                        print(f"Catalog {run_id}: row {key} failed ({e}), retrying in {delay:.1f}s")
+                        checkpoint.update(status="pending", error=str(e), updated=datetime.now())
+                        todo.append((key, entry, checkpoint, time.time() + delay))
+                    else:
+                        print(f"Catalog {run_id}: row {key} failed after {checkpoint['attempts']} attempts: {e}")
+                        checkpoint.update(status="failed", error=str(e), updated=datetime.now())
+                        failed += 1
+                    continue
+                save_output(checkpoint, key, TryOnCore.result_bytes_to_media(data, header_type), output_dir)
+                checkpoint.update(status="done", request_id=request_id, result_url=result_url, error=None,
+                                  updated=datetime.now())
+                row_seconds.append(time.time() - submitted)
+                done += 1
+                if (done + failed) % CATALOG_PROGRESS_EVERY == 0:
+                    print(f"Catalog {run_id}: {done} done, {failed} failed, {len(todo)} waiting")
+            todo = deque(sorted(todo, key=lambda item: item[3]))
+
+    elapsed = time.time() - started
+    summary = {
+        "run_id": run_id,
+        "done": done,
+        "failed": failed,
+        "skipped": skipped,
+        "elapsed_s": round(elapsed, 1),
+        "rows_per_min": round(60 * done / elapsed, 2) if elapsed else 0.0,
+        "avg_row_s": round(sum(row_seconds) / len(row_seconds), 1) if row_seconds else 0.0,
+    }
+    print(f"Catalog {run_id} finished: {summary}")
+    return summary
+
+
+def run_catalog(manifest, run_id):
+    """Background-task entry point: run a manifest with outputs stored in catalog_rows."""
+    return run_manifest(manifest, run_id)
+
+
+def start_catalog_run(manifest, run_id=None):
+    """
+    Start (or resume, given the same run_id) a catalog run from a CSV manifest Media.
+    Image references must be URLs here. Admins only. Returns the run_id.
+    """
+    TryOnCore.CallContext().require_admin()
+    run_id = run_id or uuid.uuid4().hex
+    anvil.server.launch_background_task('run_catalog', manifest, run_id)
+    return run_id
+
+
+def get_catalog_run(run_id):
+    """Row counts per status for a catalog run (admins only)."""
+    TryOnCore.CallContext().require_admin()
+    counts = {}
+    for row in app_tables.catalog_rows.search(run_id=run_id):
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    return counts
@@ -0,0 +1,191 @@
+"""
+Shared HTTP client for every ModelsLab call made by the server code.
+
+One pooled, keep-alive requests.Session is kept per server process so uploads,
+submits, polls, downloads and deletes reuse TCP+TLS connections. Requests that
+hit a 429/5xx or a connection error are retried with exponential backoff and
+jitter, and per-operation latency counters are kept for monitoring.
+"""
+
+import base64
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# Connection pool
+POOL_CONNECTIONS = 4      # number of distinct hosts to keep pools for
+POOL_MAXSIZE = 16         # max keep-alive connections per host
+
+# Timeouts in seconds: (connect, read)
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+# Retry policy
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5        # first retry waits ~0.5s, then 1s, 2s, ...
+BACKOFF_MAX = 8.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Non-idempotent requests (the fashion submit: each accepted one is a paid GPU job) are only
+# retried when upstream cannot have acted on them: a connection that never opened, or a 429
+NON_IDEMPOTENT_RETRY_STATUSES = (429,)
+
+# Streamed upload bodies base64-encode the image this many raw bytes at a time
+# (a multiple of 3, so chunks concatenate without padding)
+B64_CHUNK_SIZE = 48 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+# Path segments that identify one job or file rather than an endpoint
+ID_SEGMENT = re.compile(r"^\d+$|\.|^[0-9a-fA-F-]{16,}$")
+
+_latency = {}
+_latency_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide pooled session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def endpoint_name(url):
+    """
+    Latency counter key for a request made without an operation name: host plus path, with
+    numeric ids, long hex ids and file names collapsed (fetch/12345, generations/<uuid>-0.png
+    -> :id), so per-job URLs don't each get their own counter.
+    """
+    parsed = urlparse(url)
+    segments = [":id" if ID_SEGMENT.search(segment) else segment for segment in parsed.path.strip("/").split("/")]
+    return parsed.netloc + "/" + "/".join(segments)
+
+
+def record_latency(endpoint, elapsed, ok):
+    with _latency_lock:
+        stats = _latency.setdefault(endpoint, {"count": 0, "errors": 0, "total_s": 0.0, "max_s": 0.0})
+        stats["count"] += 1
+        if not ok:
+            stats["errors"] += 1
+        stats["total_s"] += elapsed
+        stats["max_s"] = max(stats["max_s"], elapsed)
+
+
+def latency_stats():
+    """Return a snapshot of per-operation request counts and latencies (ms)."""
+    with _latency_lock:
+        return {
+            endpoint: {
+                "count": s["count"],
+                "errors": s["errors"],
+                "avg_ms": round(1000 * s["total_s"] / s["count"], 1) if s["count"] else 0.0,
+                "max_ms": round(1000 * s["max_s"], 1),
+            }
+            for endpoint, s in _latency.items()
+        }
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number 'attempt' (0-based), with full jitter."""
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def iter_base64_chunks(image_bytes, chunk_size=B64_CHUNK_SIZE):
+    """Yield the base64 encoding of 'image_bytes' one chunk at a time."""
+    view = memoryview(image_bytes)
+    for offset in range(0, len(view), chunk_size):
+        yield base64.b64encode(view[offset:offset + chunk_size])
+
+
+def iter_crop_payload(api_key, image_bytes, content_type):
+    """
+    Yield the crop endpoint's JSON body as a stream: the key/options prefix,
+    the image as base64 chunks inside a data URI, then the closing quote and brace.
+    """
+    data_uri_start = json.dumps(f"data:{content_type};base64,")[:-1]  # opening quote, no closing quote
+    yield ('{"key": ' + json.dumps(api_key) + ', "crop": "false", "image": ' + data_uri_start).encode("utf-8")
+    yield from iter_base64_chunks(image_bytes)
+    yield b'"}'
+
+
+def connect_failed(error):
+    """True if a requests exception happened before any connection was made (nothing was sent)."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def request(method, url, timeout=None, retries=MAX_RETRIES, body_factory=None, op=None, idempotent=True, **kwargs):
+    """
+    Send a request through the pooled session.
+    Retries 429/5xx responses and connection errors; the last response is returned
+    as-is so callers keep their own status handling. With idempotent=False only
+    failed connects and 429s are retried, so a request upstream may have accepted
+    is never sent twice.
+    A streamed body is passed as 'body_factory', a callable returning a fresh
+    iterator for each attempt (an iterator can only be sent once).
+    Latency is recorded under 'op' (upload/submit/fetch/download/delete) if given.
+    """
+    session = get_session()
+    endpoint = op or endpoint_name(url)
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    retry_statuses = RETRY_STATUSES if idempotent else NON_IDEMPOTENT_RETRY_STATUSES
+    attempt = 0
+    while True:
+        if body_factory is not None:
+            kwargs["data"] = body_factory()
+        start = time.perf_counter()
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_latency(endpoint, time.perf_counter() - start, False)
+            if attempt >= retries or not (idempotent or connect_failed(e)):
+                raise
+            delay = backoff_delay(attempt)
+            print(f"{method} {endpoint} failed ({e}), retrying in {delay:.1f}s")
+        else:
+            ok = resp.status_code not in retry_statuses
+            record_latency(endpoint, time.perf_counter() - start, resp.status_code not in RETRY_STATUSES)
+            if ok or attempt >= retries:
+                return resp
+            delay = backoff_delay(attempt, resp.headers.get("Retry-After"))
+            print(f"{method} {endpoint} returned {resp.status_code}, retrying in {delay:.1f}s")
+            resp.close()
+        attempt += 1
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post_json(url, payload, **kwargs):
+    """POST 'payload' as a JSON body."""
+    headers = {"Content-Type": "application/json"}
+    return request("POST", url, headers=headers, data=json.dumps(payload), **kwargs)
+
+
+def post_stream(url, body_factory, content_type="application/json", **kwargs):
+    """POST a body produced chunk by chunk (sent with chunked transfer encoding)."""
+    headers = {"Content-Type": content_type}
+    return request("POST", url, headers=headers, body_factory=body_factory, **kwargs)
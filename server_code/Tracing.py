@@ -0,0 +1,114 @@
+"""
+Lightweight per-job tracing for the try-on pipeline.
+
+A Trace collects timed spans (stage, duration, payload size) in memory while a call or
+background task runs. Spans can be recorded from worker threads and from event-loop
+coroutines; flush() writes them to the job_metrics table and, like every other table
+call, must run on the thread that owns the request.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+PERCENTILES = (50, 95, 99)
+
+
+class Trace:
+    """
+    Collects spans for one job (or, with job_id None, for work not tied to a job yet).
+
+        trace = Trace(job_id)
+        with trace.span("download") as span:
+            data = download(...)
+            span["bytes"] = len(data)
+        trace.flush()
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, size=None, ok=True, job_id=None):
+        with self._lock:
+            self._spans.append({
+                "job_id": job_id,
+                "stage": stage,
+                "seconds": seconds,
+                "bytes": size,
+                "ok": ok,
+                "recorded": time.time(),
+            })
+
+    @contextmanager
+    def span(self, stage, size=None, job_id=None):
+        """Time the enclosed block. The yielded dict's "bytes" can be set inside the block."""
+        info = {"bytes": size}
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield info
+            ok = True
+        finally:
+            self.record(stage, time.perf_counter() - start, info["bytes"], ok, job_id)
+
+    async def timed(self, stage, coro, job_ids=(), size=None):
+        """Await 'coro', recording one span per job id (or one for the trace's own job)."""
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await coro
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            for job_id in (job_ids or [None]):
+                self.record(stage, elapsed, size, ok, job_id)
+
+    def flush(self):
+        """Write the collected spans to job_metrics. Never raises: tracing must not fail a request."""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        try:
+            with tables.Transaction():
+                for span in spans:
+                    app_tables.job_metrics.add_row(
+                        job_id=span["job_id"] or self.job_id,
+                        stage=span["stage"],
+                        seconds=span["seconds"],
+                        bytes=span["bytes"],
+                        ok=span["ok"],
+                        recorded=span["recorded"],
+                    )
+        except Exception as e:
+            print(f"Failed to store {len(spans)} trace spans: {e}")
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def stage_percentiles(since):
+    """Per-stage count, error count and p50/p95/p99 durations (ms) for spans recorded after 'since'."""
+    durations = {}
+    errors = {}
+    for row in app_tables.job_metrics.search(recorded=q.greater_than(since)):
+        durations.setdefault(row["stage"], []).append(row["seconds"])
+        if not row["ok"]:
+            errors[row["stage"]] = errors.get(row["stage"], 0) + 1
+    stats = {}
+    for stage, values in durations.items():
+        values.sort()
+        stats[stage] = {"count": len(values), "errors": errors.get(stage, 0)}
+        for pct in PERCENTILES:
+            stats[stage][f"p{pct}_ms"] = round(1000 * percentile(values, pct), 1)
+    return stats
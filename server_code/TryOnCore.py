@@ -0,0 +1,1622 @@
+"""
+The try-on server code: uploads, the admission queue and dispatcher, the shared poller,
+result storage and cleanup. Nothing here is registered with Anvil - ServerModule1 does
+that - so uplink scripts such as the benchmark can import this module without taking
+over the live app's server functions.
+"""
+
+import anvil.secrets
+import anvil.microsoft.auth
+import anvil.facebook.auth
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.users
+import anvil.server
+import anvil
+import json
+import time
+import io
+import hashlib
+import uuid
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+import anvil.users
+from datetime import datetime, timedelta
+from . import ModelsLabClient
+from . import AsyncModelsLab
+from . import Tracing
+
+API_URL = "https://modelslab.com/api/v6/image_editing/fashion"
+CROP_API_URL = "https://modelslab.com/api/v3/base64_crop"
+DELETE_API_URL = "https://modelslab.com/api/v3/delete_image"
+
+# Per-request buffer budget: uploads and downloaded results larger than this are rejected
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Result delivery: results are transcoded to RESULT_FORMAT ("PNG", "JPEG" or "WEBP") at
+# RESULT_QUALITY unless they are already in that format. RESULT_PASSTHROUGH_TYPES lists any
+# other content types to send as-is (empty by default, so RESULT_FORMAT always applies).
+RESULT_FORMAT = "PNG"
+RESULT_QUALITY = 90
+RESULT_PASSTHROUGH_TYPES = ()
+
+# Poll responses carry a small JPEG preview of the result (fitted inside PREVIEW_SIZE);
+# the full image is stored in result_media and fetched on demand with get_full_result
+PREVIEW_SIZE = (192, 256)
+PREVIEW_QUALITY = 70
+
+# Result store: every distinct output (by result_url) is kept once in result_media (full
+# image + preview) and all reads are served from there; jobs find it through their own
+# result_url. The stored size is kept as a running total on the "result_media" cache_stats
+# row, and least recently used entries are evicted once it exceeds RESULT_STORE_MAX_BYTES.
+RESULT_STORE_MAX_BYTES = 500 * 1024 * 1024
+
+# Upload normalization: before upload_to_sd, images are decoded once, EXIF-rotated, resized to
+# the generation size (OUTPUT_WIDTH x OUTPUT_HEIGHT) and re-encoded once as JPEG.
+# NORMALIZE_MODE "pad" letterboxes the whole photo, "crop" fills the frame and trims the edges.
+NORMALIZE_UPLOADS = True
+NORMALIZE_MODE = "pad"
+NORMALIZE_QUALITY = 90
+NORMALIZE_PAD_COLOR = (255, 255, 255)
+
+# Webhook-driven completion: ModelsLab POSTs finished jobs to WEBHOOK_PATH + <token>.
+# Upstream is only polled if no webhook has arrived WEBHOOK_GRACE_SECONDS after the ETA.
+WEBHOOK_PATH = "/modelslab/webhook/"
+WEBHOOK_GRACE_SECONDS = 15
+LONG_POLL_SECONDS = 20
+LONG_POLL_INTERVAL = 1
+
+# Shared poller: one background task polls every in-flight fetch_url on behalf of all clients.
+# After each upstream check the next one is scheduled at the reported ETA, clamped to these bounds.
+POLLER_TICK_SECONDS = 2
+POLLER_IDLE_EXIT_SECONDS = 120
+POLL_MIN_INTERVAL = 3
+POLL_MAX_INTERVAL = 30
+POLLER_STALL_SECONDS = 60
+# A job is failed after POLL_MAX_ERRORS fetch errors in a row, or once it has been running
+# upstream for JOB_MAX_SECONDS without finishing
+POLL_MAX_ERRORS = 10
+JOB_MAX_SECONDS = 600
+
+# Upload cache: SHA-256 of the image bytes -> ModelsLab link. Links are only reused while
+# upstream still keeps the image, which matches our 24h cleanup window.
+UPLOAD_CACHE_TTL_HOURS = 24
+
+# Result cache: the seed is fixed, so an identical parameter tuple always gives the same
+# output. Entries expire with the upstream image and are evicted least-recently-used
+# beyond RESULT_CACHE_MAX_ENTRIES.
+RESULT_CACHE_TTL_HOURS = 24
+RESULT_CACHE_MAX_ENTRIES = 500
+
+# Concurrency limits for fan-out to ModelsLab from a single server call
+UPLOAD_MAX_CONCURRENCY = 4
+BATCH_MAX_ITEMS = 50
+BATCH_IMAGES_PER_STATUS = 6   # finished images returned per get_batch_status call
+
+# Admission queue: submissions are queued in try_on_jobs and a background dispatcher sends
+# them upstream round-robin across users, keeping at most MAX_IN_FLIGHT_JOBS running (catalog
+# runs included) and staying within a token bucket of RATE_LIMIT_PER_MINUTE (bursts up to
+# RATE_LIMIT_BURST)
+MAX_IN_FLIGHT_JOBS = 20
+RATE_LIMIT_PER_MINUTE = 30
+RATE_LIMIT_BURST = 10
+DISPATCH_MAX_CONCURRENCY = 4
+DISPATCH_TICK_SECONDS = 1
+TYPICAL_JOB_SECONDS = 30   # used for queue wait estimates
+# A claimed job is "submitting" while its POST is in flight; one still submitting after this
+# long (the dispatcher died mid-request) is put back in the queue by the watchdog
+SUBMIT_STALL_SECONDS = 180
+# Catalog rows still "running" after this long belong to a run that was killed and no
+# longer hold an in-flight slot
+CATALOG_STALE_SECONDS = 900
+
+# Single-flight: a submission identical (same params_hash) to a job already queued or running
+# is attached to that job instead of going upstream again, unless the job is older than this
+SINGLE_FLIGHT_MAX_AGE_MINUTES = 30
+
+# Cleanup sweeper (scheduled every 5 minutes): pages through expired jobs oldest-first
+# in CLEANUP_BATCH_SIZE batches, deleting upstream concurrently, and stops after
+# CLEANUP_MAX_SECONDS. Progress is checkpointed in cleanup_state so the next run resumes.
+CLEANUP_RETENTION_HOURS = 24
+CLEANUP_BATCH_SIZE = 100
+CLEANUP_DELETE_CONCURRENCY = 8
+CLEANUP_MAX_SECONDS = 240
+# Part of CLEANUP_MAX_SECONDS kept back for catalog rows, assets, caches, stored results and
+# metrics, which are deleted in CLEANUP_BATCH_SIZE pages after the job sweep
+CLEANUP_SIDE_TABLE_SECONDS = 60
+
+# Per-stage timing spans are kept in job_metrics for this long
+METRICS_RETENTION_HOURS = 7 * 24
+
+# Fixed generation settings
+BASE_PROMPT = "A realistic photo of the model wearing the cloth, Maintain color and texture"
+BASE_NEGATIVE_PROMPT = "Low quality, unrealistic, warped cloth, cloth's hand length should not change"
+OUTPUT_HEIGHT = 512
+OUTPUT_WIDTH = 384
+DEFAULT_SEED = 128915590
+
+# Get API key from Anvil Secrets
+API_KEY = anvil.secrets.get_secret('modelslab_api_key')  # Store your API key in Anvil Secrets
+
+# -------------
+# Helper funcs
+# -------------
+class CallContext:
+    """
+    Per-call cache of the logged-in user, their email and the job rows a call works on,
+    so each is fetched from the users/tables services at most once per server call.
+    Create one at the top of a callable and pass it down.
+    """
+    def __init__(self):
+        self._user = None
+        self._user_loaded = False
+        self._jobs = {}
+
+    @property
+    def user(self):
+        """The logged-in user row, or None."""
+        if not self._user_loaded:
+            self._user = anvil.users.get_user()
+            self._user_loaded = True
+        return self._user
+
+    def require_user(self):
+        if not self.user:
+            raise Exception("Authentication required")
+        return self.user
+
+    def require_admin(self):
+        if not self.user or not self.user['admin']:
+            raise Exception("Admin access required")
+        return self.user
+
+    @property
+    def email(self):
+        return self.require_user()['email']
+
+    def job(self, job_id, refresh=False):
+        """The user's try_on_jobs row for 'job_id' (None if missing or not theirs)."""
+        if refresh or job_id not in self._jobs:
+            self._jobs[job_id] = app_tables.try_on_jobs.get(job_id=job_id, user=self.email)
+        return self._jobs[job_id]
+
+def get_media_bytes(media):
+    """Return the bytes of an anvil Media object, enforcing MAX_IMAGE_BYTES."""
+    data = media.get_bytes()
+    if len(data) > MAX_IMAGE_BYTES:
+        raise Exception(f"Image too large: {len(data)} bytes (limit {MAX_IMAGE_BYTES})")
+    return data
+
+
+def download_image(image_url):
+    """Download 'image_url' into memory and return (bytes, content_type header)."""
+    resp = ModelsLabClient.get(image_url, stream=True, op="download")
+    if resp.status_code != 200:
+        resp.close()
+        raise Exception(f"Failed to download image. Status: {resp.status_code}")
+    content_type = resp.headers.get("Content-Type", "")
+    buf = io.BytesIO()
+    try:
+        for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buf.write(chunk)
+            if buf.tell() > MAX_IMAGE_BYTES:
+                raise Exception(f"Downloaded image exceeds {MAX_IMAGE_BYTES} bytes")
+    finally:
+        resp.close()
+    return buf.getbuffer(), content_type
+
+IMAGE_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+FORMAT_CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+CONTENT_TYPE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+def sniff_image_type(data, header_type=""):
+    """Work out the image content type from magic bytes, falling back to the HTTP header."""
+    head = bytes(data[:12])
+    for magic, content_type in IMAGE_MAGIC:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    header_type = header_type.split(";")[0].strip().lower()
+    if header_type.startswith("image/"):
+        return header_type
+    return None
+
+def transcode_image(data, fmt=None, quality=None):
+    """Decode 'data' with PIL and re-encode it as 'fmt'. Returns (bytes, content_type)."""
+    fmt = (fmt or RESULT_FORMAT).upper()
+    quality = quality or RESULT_QUALITY
+    if fmt not in FORMAT_CONTENT_TYPES:
+        raise Exception(f"Unsupported result format: {fmt}")
+    with Image.open(io.BytesIO(data)) as img:
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        if fmt == "PNG":
+            img.save(buf, format="PNG")
+        else:
+            img.save(buf, format=fmt, quality=quality)
+    return buf.getvalue(), FORMAT_CONTENT_TYPES[fmt]
+
+def flatten_to_rgb(img, background):
+    """Convert 'img' to RGB, compositing any transparency onto 'background' instead of black."""
+    if img.mode == "P" and "transparency" in img.info:
+        img = img.convert("RGBA")
+    if img.mode in ("RGBA", "LA", "PA"):
+        out = Image.new("RGB", img.size, background)
+        out.paste(img.convert("RGBA"), mask=img.getchannel("A"))
+        return out
+    return img.convert("RGB")
+
+def normalize_image(image_bytes, width=None, height=None, mode=None, quality=None):
+    """
+    Fit an uploaded image to width x height in a single decode/encode pass.
+    JPEGs are decoded at reduced scale (draft mode) and resizing uses reducing_gap
+    so large photos are shrunk cheaply before the final high-quality filter.
+    Returns (jpeg_bytes, "image/jpeg").
+    """
+    width = width or OUTPUT_WIDTH
+    height = height or OUTPUT_HEIGHT
+    mode = mode or NORMALIZE_MODE
+    quality = quality or NORMALIZE_QUALITY
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if img.format == "JPEG":
+            # Any EXIF rotation swaps the axes, so ask for enough pixels either way round
+            side = max(width, height)
+            img.draft("RGB", (side, side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = flatten_to_rgb(img, NORMALIZE_PAD_COLOR)
+
+        src_w, src_h = img.size
+        if mode == "crop":
+            # Scale to cover the frame, then take the centred window
+            scale = max(width / src_w, height / src_h)
+            box_w, box_h = width / scale, height / scale
+            left, top = (src_w - box_w) / 2, (src_h - box_h) / 2
+            out = img.resize((width, height), Image.LANCZOS,
+                             box=(left, top, left + box_w, top + box_h), reducing_gap=2.0)
+        elif mode == "pad":
+            # Scale to fit inside the frame, then centre on a plain background
+            scale = min(width / src_w, height / src_h)
+            fit_w, fit_h = max(1, round(src_w * scale)), max(1, round(src_h * scale))
+            fitted = img.resize((fit_w, fit_h), Image.LANCZOS, reducing_gap=2.0)
+            out = Image.new("RGB", (width, height), NORMALIZE_PAD_COLOR)
+            out.paste(fitted, ((width - fit_w) // 2, (height - fit_h) // 2))
+        else:
+            raise Exception(f"Unsupported normalize mode: {mode}")
+
+        buf = io.BytesIO()
+        out.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+def get_image_as_media(image_url, trace=None):
+    """
+    Download the final image from 'image_url' and return as anvil.BlobMedia.
+    The upstream bytes are passed through untouched when they are already in RESULT_FORMAT;
+    otherwise they are transcoded to it.
+    """
+    trace = trace or Tracing.Trace()
+    with trace.span("download") as span:
+        raw, header_type = download_image(image_url)
+        span["bytes"] = len(raw)
+    return result_bytes_to_media(raw, header_type, trace)
+
+def result_bytes_to_media(raw, header_type, trace=None):
+    """Wrap downloaded result bytes as BlobMedia, transcoding unless already in RESULT_FORMAT (or passthrough)."""
+    trace = trace or Tracing.Trace()
+    content_type = sniff_image_type(raw, header_type)
+    if content_type == FORMAT_CONTENT_TYPES[RESULT_FORMAT.upper()] or content_type in RESULT_PASSTHROUGH_TYPES:
+        data = bytes(raw)
+    else:
+        print(f"Transcoding result from {content_type} to {RESULT_FORMAT}")
+        with trace.span("transcode", size=len(raw)):
+            data, content_type = transcode_image(raw)
+    name = "sdoutput." + CONTENT_TYPE_EXTENSIONS[content_type]
+    return anvil.BlobMedia(content_type, data, name=name)
+
+def make_preview(data):
+    """Shrink a result image to a small JPEG preview (BlobMedia)."""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", PREVIEW_SIZE)
+        img = img.convert("RGB")
+        img.thumbnail(PREVIEW_SIZE, Image.LANCZOS, reducing_gap=2.0)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=PREVIEW_QUALITY, optimize=True)
+    return anvil.BlobMedia("image/jpeg", buf.getvalue(), name="sdoutput-preview.jpg")
+
+def add_result_media(row, full, trace=None):
+    """Store a finished job's output (full image and a preview) in result_media under its result_url."""
+    trace = trace or Tracing.Trace()
+    full_bytes = full.get_bytes()
+    with trace.span("preview", size=len(full_bytes)):
+        preview = make_preview(full_bytes)
+    size = len(full_bytes) + len(preview.get_bytes())
+    with trace.span("table_write", job_id=row['job_id']):
+        now = datetime.now()
+        stored = app_tables.result_media.add_row(
+            result_url=row['result_url'],
+            full=full,
+            preview=preview,
+            bytes=size,
+            created=now,
+            last_used=now
+        )
+    evict_result_media(add_result_store_bytes(size))
+    return stored
+
+@tables.in_transaction
+def add_result_store_bytes(delta):
+    """Add 'delta' to the running size of result_media and return the new total."""
+    row = app_tables.cache_stats.get(name="result_media")
+    if row is None:
+        row = app_tables.cache_stats.add_row(name="result_media", hits=0, misses=0)
+    if row['bytes'] is None:
+        # First use: count what is already stored, once
+        row['bytes'] = sum(stored['bytes'] or 0 for stored in app_tables.result_media.search()) - delta
+    row['bytes'] = max(0, row['bytes'] + delta)
+    return row['bytes']
+
+def delete_result_media(rows):
+    """Delete result_media rows and take their size off the running total."""
+    freed = 0
+    for stored in rows:
+        freed += stored['bytes'] or 0
+        stored.delete()
+    if freed:
+        add_result_store_bytes(-freed)
+
+def evict_result_media(total):
+    """Drop least recently used stored results until 'total' fits in RESULT_STORE_MAX_BYTES."""
+    if total <= RESULT_STORE_MAX_BYTES:
+        return
+    evicted = []
+    for stored in app_tables.result_media.search(tables.order_by("last_used", ascending=True)):
+        print(f"Evicting stored result {stored['result_url']}")
+        evicted.append(stored)
+        total -= stored['bytes'] or 0
+        if total <= RESULT_STORE_MAX_BYTES:
+            break
+    delete_result_media(evicted)
+
+def get_result_media(row, trace=None):
+    """
+    The result_media row (full image + preview) for a finished job, found by its result_url,
+    so every job with the same output (result-cache hits, attached duplicates) shares one
+    stored copy. Results are normally stored as soon as the job finishes; ModelsLab is only
+    contacted if there is no stored copy at all (e.g. it was evicted).
+    """
+    for stored in app_tables.result_media.search(result_url=row['result_url']):
+        record_cache_event("result_media", True)
+        stored['last_used'] = datetime.now()
+        return stored
+    record_cache_event("result_media", False)
+    return add_result_media(row, get_image_as_media(row['result_url'], trace), trace)
+
+def store_finished_results(rows, trace, runner=None):
+    """
+    Download the outputs of jobs that just finished (concurrently) and put them in the
+    result store, so no later read has to go upstream.
+    """
+    by_url = {}
+    for row in rows:
+        if row['result_url'] not in by_url and len(app_tables.result_media.search(result_url=row['result_url'])) == 0:
+            by_url[row['result_url']] = row
+    rows = list(by_url.values())
+    if not rows:
+        return
+    results = run_async_modelslab(lambda client: client.gather(
+        trace.timed("download", client.download(row['result_url'], MAX_IMAGE_BYTES), [row['job_id']])
+        for row in rows
+    ), runner)
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            # get_result_media downloads it on first read instead
+            print(f"Could not store result for job {row['job_id']}: {result}")
+            continue
+        data, header_type = result
+        add_result_media(row, result_bytes_to_media(data, header_type, trace), trace)
+
+def extract_result_url(data):
+    """Pick the final image link out of a ModelsLab success response."""
+    for key in ("output", "proxy_links", "future_links"):
+        if data.get(key):
+            return data[key][0]
+    return None
+
+def record_job_result(row, data):
+    """Store a ModelsLab job response (webhook body or fetch response) on its try_on_jobs row."""
+    status = data.get("status")
+    if status == "success":
+        final_url = extract_result_url(data)
+        if not final_url:
+            row.update(status="failed", error="No final image link found in success response!", updated=datetime.now())
+            return
+        row.update(status="success", result_url=final_url, updated=datetime.now())
+        store_result_cache(row['params_hash'], final_url)
+    elif status == "processing":
+        eta = data.get("eta", 10)
+        wait = min(max(eta, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+        row.update(eta=eta, next_poll=time.time() + wait, fetch_errors=0, updated=datetime.now())
+    else:
+        row.update(status="failed", error=str(data.get("message") or data.get("messege") or data), updated=datetime.now())
+    update_followers(row)
+
+def fail_job(row, error):
+    """Mark an unfinished job failed and pass the outcome on to its attached duplicates."""
+    print(f"Job {row['job_id']} failed: {error}")
+    row.update(status="failed", error=error, updated=datetime.now())
+    update_followers(row)
+
+def update_followers(leader):
+    """
+    Copy a finished job's outcome onto the identical submissions attached to it.
+    request_id is not copied: the upstream images belong to the leader, so only the
+    leader's row ever deletes them.
+    """
+    if leader['status'] not in ("success", "failed"):
+        return
+    for follower in app_tables.try_on_jobs.search(leader_job_id=leader['job_id'], status="attached"):
+        follower.update(
+            status=leader['status'],
+            result_url=leader['result_url'],
+            error=leader['error'],
+            updated=datetime.now()
+        )
+
+@tables.in_transaction
+def enqueue_or_attach(row):
+    """
+    Single-flight admission for a new job row: if an identical job (same params_hash) is
+    already queued or running, attach 'row' to it and return that leader row; otherwise
+    queue 'row' for the dispatcher and return None.
+    """
+    recent = q.greater_than(datetime.now() - timedelta(minutes=SINGLE_FLIGHT_MAX_AGE_MINUTES))
+    for leader in app_tables.try_on_jobs.search(params_hash=row['params_hash'],
+                                                status=q.any_of("queued", "submitting", "processing"), created=recent):
+        row.update(status="attached", leader_job_id=leader['job_id'], updated=datetime.now())
+        return leader
+    row.update(status="queued", queued_at=time.time())
+    return None
+
+def settle_attached(row):
+    """
+    For an attached job: return its leader if that is still in flight. Otherwise copy the
+    leader's outcome onto the row (or fail it if the leader is gone) and return None.
+    """
+    leader = app_tables.try_on_jobs.get(job_id=row['leader_job_id'])
+    if leader is None:
+        row.update(status="failed", error="The identical job this was attached to was deleted",
+                   updated=datetime.now())
+        return None
+    if leader['status'] in ("success", "failed"):
+        update_followers(leader)
+        return None
+    return leader
+
+@tables.in_transaction
+def hand_off_followers(leader):
+    """
+    Before an unfinished job is deleted, make its oldest attached duplicate the new leader
+    (requeued in the old leader's place) and attach the rest to it. Returns the new leader or None.
+    """
+    followers = list(app_tables.try_on_jobs.search(tables.order_by("created"),
+                                                   leader_job_id=leader['job_id'], status="attached"))
+    if not followers:
+        return None
+    new_leader = followers[0]
+    new_leader.update(status="queued", leader_job_id=None, queued_at=leader['queued_at'] or time.time(),
+                      updated=datetime.now())
+    for follower in followers[1:]:
+        follower['leader_job_id'] = new_leader['job_id']
+    return new_leader
+
+def attached_status(leader):
+    """check_try_on/start_try_on response for a job attached to 'leader' that is still in flight."""
+    if leader['status'] == "queued":
+        return queue_status(leader)
+    if leader['status'] == "submitting":
+        return {"status": "processing", "eta": TYPICAL_JOB_SECONDS}
+    return {"status": "processing", "eta": leader['eta'] or 10}
+
+@tables.in_transaction
+def record_cache_event(cache_name, hit):
+    """Count a hit or miss for 'cache_name' in the cache_stats table."""
+    row = app_tables.cache_stats.get(name=cache_name)
+    if row is None:
+        row = app_tables.cache_stats.add_row(name=cache_name, hits=0, misses=0)
+    if hit:
+        row['hits'] = (row['hits'] or 0) + 1
+    else:
+        row['misses'] = (row['misses'] or 0) + 1
+
+def lookup_upload_cache(digest):
+    """Return the cached ModelsLab link for an image digest, or None if absent/expired."""
+    cutoff = datetime.now() - timedelta(hours=UPLOAD_CACHE_TTL_HOURS)
+    for row in app_tables.upload_cache.search(digest=digest, created=q.greater_than(cutoff)):
+        return row['link']
+    return None
+
+def try_on_cache_key(model_url, cloth_url, cloth_type, prompt, negative_prompt, guidance_scale, num_steps, height, width, seed):
+    """Canonical SHA-256 of everything that determines a try-on result."""
+    params = {
+        "model_url": model_url,
+        "cloth_url": cloth_url,
+        "cloth_type": cloth_type,
+        "prompt": (prompt or "").strip(),
+        "negative_prompt": (negative_prompt or "").strip(),
+        "guidance_scale": float(guidance_scale),
+        "num_steps": int(num_steps),
+        "height": int(height),
+        "width": int(width),
+        "seed": int(seed),
+    }
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def lookup_result_cache(key):
+    """Return the cached result URL for a parameter hash, refreshing its LRU timestamp."""
+    cutoff = datetime.now() - timedelta(hours=RESULT_CACHE_TTL_HOURS)
+    for row in app_tables.result_cache.search(key=key, created=q.greater_than(cutoff)):
+        row.update(last_used=datetime.now(), hits=(row['hits'] or 0) + 1)
+        return row['result_url']
+    return None
+
+def store_result_cache(key, result_url):
+    """Remember a finished result and evict the least recently used entries over the cap."""
+    if not key or not result_url:
+        return
+    if len(app_tables.result_cache.search(key=key)) > 0:
+        return
+    now = datetime.now()
+    app_tables.result_cache.add_row(key=key, result_url=result_url, created=now, last_used=now, hits=0)
+    excess = len(app_tables.result_cache.search()) - RESULT_CACHE_MAX_ENTRIES
+    if excess > 0:
+        for old in list(app_tables.result_cache.search(tables.order_by("last_used", ascending=True))[:excess]):
+            old.delete()
+
+def post_crop_upload(image_bytes, content_type):
+    """
+    Send image bytes to the crop endpoint and return the link.
+    The JSON body is streamed (chunked), so only one encoded chunk is held at a time.
+    Makes no table calls, so it is safe to run on worker threads.
+    """
+    resp = ModelsLabClient.post_stream(CROP_API_URL, lambda: ModelsLabClient.iter_crop_payload(API_KEY, image_bytes, content_type),
+                                       op="upload")
+    if resp.status_code == 200:
+        data = resp.json()
+        if "link" in data:
+            return data["link"]
+        else:
+            raise Exception(f"Unexpected response: {data}")
+    else:
+        raise Exception(f"Failed upload_to_sd: {resp.text}")
+
+def normalize_and_upload(image_bytes, content_type, trace=None):
+    """Normalize (if enabled) and upload one image. Safe to run on worker threads."""
+    trace = trace or Tracing.Trace()
+    if NORMALIZE_UPLOADS:
+        with trace.span("normalize", size=len(image_bytes)):
+            image_bytes, content_type = normalize_image(image_bytes)
+    with trace.span("upload_to_sd", size=len(image_bytes)):
+        return post_crop_upload(image_bytes, content_type)
+
+def upload_many(medias, max_workers=UPLOAD_MAX_CONCURRENCY, trace=None):
+    """
+    Upload several images and return their links in order.
+    Cache hits (keyed on the original bytes) are answered from upload_cache;
+    misses are normalized and uploaded concurrently.
+    """
+    trace = trace or Tracing.Trace()
+    links = [None] * len(medias)
+    misses = []
+    for i, media in enumerate(medias):
+        image_bytes = get_media_bytes(media)
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        cached_link = lookup_upload_cache(digest)
+        record_cache_event("upload", cached_link is not None)
+        if cached_link:
+            print(f"Upload cache hit for {digest[:12]}")
+            links[i] = cached_link
+        else:
+            misses.append((i, digest, image_bytes, media.content_type or "image/png"))
+
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(misses))) as pool:
+            uploaded = list(pool.map(lambda miss: normalize_and_upload(miss[2], miss[3], trace), misses))
+        with trace.span("table_write"):
+            for (i, digest, _, _), link in zip(misses, uploaded):
+                app_tables.upload_cache.add_row(digest=digest, link=link, created=datetime.now())
+                links[i] = link
+    return links
+
+def upload_to_sd(image_media):
+    """
+    Upload an image for cropping (or just uploading) and return the link.
+    If the API requires 'key' in JSON body, we do it here.
+    Identical bytes uploaded within UPLOAD_CACHE_TTL_HOURS reuse the earlier link.
+    """
+    return upload_many([image_media])[0]
+
+def build_fashion_payload(model_url, cloth_url, cloth_type, prompt, negative_prompt, guidance_scale, num_steps, webhook_token):
+    """Build the fashion API request body for one try-on."""
+    return {
+        "key": API_KEY,
+        "prompt": f"{BASE_PROMPT}, {prompt}".strip(),
+        "negative_prompt": f"{BASE_NEGATIVE_PROMPT}, {negative_prompt}".strip(),
+        "init_image": model_url,
+        "cloth_image": cloth_url,
+        "cloth_type": cloth_type,
+        "height": OUTPUT_HEIGHT,
+        "width": OUTPUT_WIDTH,
+        "guidance_scale": guidance_scale,
+        "num_inference_steps": num_steps,
+        "seed": DEFAULT_SEED,
+        "temp": "no",
+        "webhook": anvil.server.get_api_origin() + WEBHOOK_PATH + webhook_token,
+        "track_id": webhook_token
+    }
+
+def apply_submit_response(row, data):
+    """Record the fashion API's answer to a submission on the job row."""
+    if data.get("id") is not None:
+        row['request_id'] = str(data["id"])
+    if data.get("status") == "processing":
+        eta = data.get("eta", 10)
+        row.update(
+            status="processing",
+            fetch_url=data["fetch_result"],
+            eta=eta,
+            next_poll=time.time() + eta + WEBHOOK_GRACE_SECONDS,
+            updated=datetime.now()
+        )
+    else:
+        record_job_result(row, data)
+
+# -------------
+# Two-step approach
+# -------------
+def latest_asset(email, kind):
+    """Return the user's most recently uploaded asset row of 'kind' ('user' or 'cloth'), or None."""
+    for asset in app_tables.assets.search(tables.order_by("created", ascending=False), user=email, kind=kind):
+        return asset
+    return None
+
+def upload_assets(email, user_media=None, cloth_media=None, trace=None):
+    """
+    Upload the given model and/or cloth images in parallel and record them as asset
+    rows in a single transaction. Returns {"user_url": ..., "cloth_url": ...} for those given.
+    """
+    given = [(kind, media) for kind, media in (("user", user_media), ("cloth", cloth_media)) if media is not None]
+    if not given:
+        return {}
+    trace = trace or Tracing.Trace()
+    links = upload_many([media for _, media in given], trace=trace)
+    with trace.span("table_write"), tables.Transaction():
+        for (kind, _), url in zip(given, links):
+            app_tables.assets.add_row(user=email, kind=kind, url=url, created=datetime.now())
+    return {f"{kind}_url": url for (kind, _), url in zip(given, links)}
+
+def start_try_on(prompt="", cloth_type="dresses", guidance_scale=10.0, num_steps=21, negative_prompt="",
+                 user_image=None, cloth_image=None):
+    """
+    1) Upload any images passed inline, otherwise use the user's most recently uploaded ones
+    2) Create a new try_on_jobs row (with its own job_id) for this submission
+    3) Queue it for the dispatcher, which POSTs it to the main fashion API
+    4) Return either:
+       - { "status": "success", "job_id": <id>, "preview": <BlobMedia> } on a result cache hit
+       - { "status": "queued", "job_id": <id>, "position": <n>, "start_in": <s>, "eta": <s> }
+         otherwise - poll check_try_on for progress
+       - { "status": "processing", "job_id": <id>, "eta": <s> } if an identical job was already
+         running; this job is attached to it and gets the same result
+    
+    Args:
+        prompt: Optional user-provided prompt to append to base prompt
+        cloth_type: The type of clothing
+        guidance_scale: The guidance scale for the Stable Diffusion model
+        num_steps: The number of inference steps for the Stable Diffusion model
+        negative_prompt: Optional user-provided negative prompt to append to base negative prompt
+        user_image: Optional model image Media, uploaded as part of this call
+        cloth_image: Optional cloth image Media, uploaded as part of this call
+    """
+
+    # Require authentication for this endpoint
+    emailID = CallContext().email
+    print("emailID:"+emailID)
+    trace = Tracing.Trace(uuid.uuid4().hex)
+    try:
+        return submit_try_on(trace, emailID, prompt, cloth_type, guidance_scale, num_steps, negative_prompt,
+                             user_image, cloth_image)
+    finally:
+        trace.flush()
+
+def submit_try_on(trace, emailID, prompt, cloth_type, guidance_scale, num_steps, negative_prompt,
+                  user_image, cloth_image):
+    """start_try_on's work, with its spans recorded on 'trace' (whose job_id the new row takes)."""
+    uploaded = upload_assets(emailID, user_image, cloth_image, trace=trace)
+    model_url = uploaded.get('user_url')
+    if model_url is None:
+        model_asset = latest_asset(emailID, 'user')
+        model_url = model_asset['url'] if model_asset else None
+    cloth_url = uploaded.get('cloth_url')
+    if cloth_url is None:
+        cloth_asset = latest_asset(emailID, 'cloth')
+        cloth_url = cloth_asset['url'] if cloth_asset else None
+
+    # Check which images are missing and provide a specific message
+    if model_url is None and cloth_url is None:
+        raise Exception("Please upload both model and cloth images first")
+    elif model_url is None:
+        raise Exception("Please upload the model image first")
+    elif cloth_url is None:
+        raise Exception("Please upload the cloth image first")
+
+    with trace.span("table_write"):
+        row = app_tables.try_on_jobs.add_row(
+            job_id=trace.job_id,
+            user=emailID,
+            created=datetime.now(),
+            updated=datetime.now(),
+            status="new",
+            user_url=model_url,
+            cloth_url=cloth_url,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            guidance_scale=guidance_scale,
+            num_steps=num_steps,
+            cloth_type=cloth_type,
+            height=OUTPUT_HEIGHT,
+            width=OUTPUT_WIDTH,
+            seed=DEFAULT_SEED,
+            webhook_token=uuid.uuid4().hex,
+            params_hash=try_on_cache_key(model_url, cloth_url, cloth_type, prompt, negative_prompt,
+                                         guidance_scale, num_steps, OUTPUT_HEIGHT, OUTPUT_WIDTH, DEFAULT_SEED)
+        )
+
+    cached_url = lookup_result_cache(row['params_hash'])
+    row['cache_hit'] = cached_url is not None
+    record_cache_event("result", row['cache_hit'])
+    if cached_url:
+        print(f"Result cache hit for {row['params_hash'][:12]}")
+        row.update(status="success", result_url=cached_url)
+        return {"status": "success", "job_id": row['job_id'], "preview": get_result_media(row, trace)['preview']}
+
+    leader = enqueue_or_attach(row)
+    if leader is not None:
+        print(f"Job {row['job_id']} attached to identical in-flight job {leader['job_id']}")
+        return dict(attached_status(leader), job_id=row['job_id'])
+    ensure_task_running('dispatch_queued_jobs')
+    return dict(queue_status(row), job_id=row['job_id'])
+
+
+def modelslab_client_kwargs(**concurrency):
+    """AsyncModelsLabClient arguments for this app's endpoints."""
+    return dict(
+        api_key=API_KEY,
+        crop_url=CROP_API_URL,
+        fashion_url=API_URL,
+        delete_url=DELETE_API_URL,
+        concurrency=concurrency
+    )
+
+def modelslab_runner(**concurrency):
+    """A reusable loop and client for long-running tasks; use as a context manager."""
+    return AsyncModelsLab.Runner(modelslab_client_kwargs(**concurrency))
+
+def run_async_modelslab(operation, runner=None, **concurrency):
+    """
+    Run 'operation(client)' with an AsyncModelsLabClient for this app's endpoints,
+    on 'runner' if given, otherwise on a one-off loop and client.
+    Keyword arguments override the per-endpoint concurrency limits (e.g. submit=4).
+    """
+    if runner is not None:
+        return runner.run(operation)
+    return AsyncModelsLab.run(modelslab_client_kwargs(**concurrency), operation)
+
+def job_status_response(row):
+    """Build the check_try_on response for a job row that has finished or failed."""
+    if row['status'] == "success":
+        trace = Tracing.Trace(row['job_id'])
+        try:
+            return {"status": "success", "job_id": row['job_id'], "preview": get_result_media(row, trace)['preview']}
+        finally:
+            trace.flush()
+    return {"status": "failed", "error": row['error'] or "Unknown error"}
+
+def check_try_on(job_id, wait=0):
+    """
+    Check one of the user's jobs by reading its try_on_jobs row - upstream polling
+    is done by the webhook and the shared poller, never by this call.
+    Waits up to 'wait' seconds (capped at LONG_POLL_SECONDS) for the row to change.
+    - If waiting in the admission queue, return {"status": "queued", "position": <n>, ...}
+    - If still processing, return {"status": "processing"}
+    - If success, return {"status": "success", "preview": <BlobMedia>} - the full image
+      comes from get_full_result
+    - If failed, return {"status": "failed", "error": <message>}
+    """
+    ctx = CallContext()
+    ctx.require_user()
+    deadline = time.time() + min(wait, LONG_POLL_SECONDS)
+    first = True
+    while True:
+        # Re-read on later iterations so updates from the poller/webhook are seen
+        row = ctx.job(job_id, refresh=not first)
+        first = False
+        if row is None:
+            return {"status": "failed", "error": "Job not found"}
+        if row['status'] in ("success", "failed"):
+            return job_status_response(row)
+
+        if row['status'] == "queued":
+            if time.time() + LONG_POLL_INTERVAL > deadline:
+                return queue_status(row)
+            time.sleep(LONG_POLL_INTERVAL)
+            continue
+
+        if row['status'] == "submitting":
+            # Claimed by the dispatcher, waiting for the fashion API to accept it
+            if time.time() + LONG_POLL_INTERVAL > deadline:
+                return {"status": "processing", "eta": TYPICAL_JOB_SECONDS}
+            time.sleep(LONG_POLL_INTERVAL)
+            continue
+
+        if row['status'] == "attached":
+            leader = settle_attached(row)
+            if leader is None:
+                continue
+            if time.time() + LONG_POLL_INTERVAL > deadline:
+                return attached_status(leader)
+            time.sleep(LONG_POLL_INTERVAL)
+            continue
+
+        if time.time() - (row['next_poll'] or 0) > POLLER_STALL_SECONDS:
+            # The poller should have picked this job up by now
+            ensure_poller_running()
+
+        if time.time() + LONG_POLL_INTERVAL > deadline:
+            return {"status": "processing", "eta": row['eta'] or 10}
+        time.sleep(LONG_POLL_INTERVAL)
+
+def ensure_task_running(task_name):
+    """Launch the named background task unless one is already running."""
+    for task in anvil.server.list_background_tasks():
+        if task.get_task_name() == task_name and task.is_running():
+            return
+    anvil.server.launch_background_task(task_name)
+
+def ensure_poller_running():
+    """Launch the shared poller unless one is already running."""
+    ensure_task_running('poll_pending_jobs')
+
+def fair_order(queued_rows):
+    """
+    Order queued jobs round-robin across users: each round takes one job per user
+    (oldest first), starting with the user whose oldest job has waited longest.
+    """
+    per_user = {}
+    for row in queued_rows:
+        per_user.setdefault(row['user'], []).append(row)
+    queues = sorted(per_user.values(), key=lambda rows: rows[0]['queued_at'])
+    ordered = []
+    for round_rows in itertools.zip_longest(*queues):
+        ordered.extend(row for row in round_rows if row is not None)
+    return ordered
+
+def queue_status(row):
+    """Queue position (1-based) and estimated seconds until a queued job starts and finishes."""
+    queued = app_tables.try_on_jobs.search(tables.order_by("queued_at"), status="queued")
+    ahead = 0
+    for ahead, queued_row in enumerate(fair_order(queued)):
+        if queued_row['job_id'] == row['job_id']:
+            break
+    # Limited by whichever is slower: the upstream rate limit or in-flight slots turning over
+    start_in = max(ahead * 60 / RATE_LIMIT_PER_MINUTE, (ahead // MAX_IN_FLIGHT_JOBS) * TYPICAL_JOB_SECONDS)
+    return {
+        "status": "queued",
+        "position": ahead + 1,
+        "start_in": round(start_in),
+        "eta": round(start_in) + TYPICAL_JOB_SECONDS
+    }
+
+def count_in_flight():
+    """Jobs holding one of the MAX_IN_FLIGHT_JOBS upstream slots, including running catalog rows."""
+    recent = q.greater_than(datetime.now() - timedelta(seconds=CATALOG_STALE_SECONDS))
+    return (len(app_tables.try_on_jobs.search(status="processing", fetch_url=q.not_(None)))
+            + len(app_tables.try_on_jobs.search(status="submitting"))
+            + len(app_tables.catalog_rows.search(status="running", updated=recent)))
+
+def rate_bucket_name():
+    """Token bucket id for the configured API key (hashed, so the key is never stored)."""
+    return "api:" + hashlib.sha256(API_KEY.encode("utf-8")).hexdigest()[:12]
+
+@tables.in_transaction
+def take_rate_tokens(bucket_name, wanted):
+    """Take up to 'wanted' tokens from a token bucket and return how many were granted."""
+    now = time.time()
+    row = app_tables.rate_limits.get(name=bucket_name)
+    if row is None:
+        row = app_tables.rate_limits.add_row(name=bucket_name, tokens=RATE_LIMIT_BURST, updated=now)
+    tokens = min(RATE_LIMIT_BURST, row['tokens'] + (now - row['updated']) * RATE_LIMIT_PER_MINUTE / 60)
+    granted = int(min(wanted, tokens))
+    row.update(tokens=tokens - granted, updated=now)
+    return granted
+
+@tables.in_transaction
+def claim_queued_jobs(rows):
+    """
+    Atomically move the rows that are still queued to "submitting" and return them.
+    Rows another dispatcher claimed (or a user deleted) in the meantime are left out,
+    so no job is submitted twice.
+    """
+    claimed = []
+    now = time.time()
+    for row in rows:
+        fresh = app_tables.try_on_jobs.get(job_id=row['job_id'])
+        if fresh is None or fresh['status'] != "queued":
+            continue
+        fresh.update(status="submitting", submitting_at=now, updated=datetime.now())
+        claimed.append(fresh)
+    return claimed
+
+@tables.in_transaction
+def requeue_stalled_submissions():
+    """Put jobs stuck in "submitting" (their dispatcher died mid-POST) back in the queue."""
+    stalled = app_tables.try_on_jobs.search(status="submitting",
+                                            submitting_at=q.less_than(time.time() - SUBMIT_STALL_SECONDS))
+    count = 0
+    for row in stalled:
+        # queued_at is kept, so the job keeps its place in line
+        row.update(status="queued", submitting_at=None, updated=datetime.now())
+        count += 1
+    if count:
+        print(f"Requeued {count} jobs stuck in submitting")
+    return count
+
+def submit_queued_jobs(rows, runner=None):
+    """Claim queued jobs, send them to the fashion API concurrently and record each response."""
+    rows = claim_queued_jobs(rows)
+    if not rows:
+        return
+    payloads = [
+        build_fashion_payload(row['user_url'], row['cloth_url'], row['cloth_type'], row['prompt'],
+                              row['negative_prompt'], row['guidance_scale'], row['num_steps'],
+                              row['webhook_token'])
+        for row in rows
+    ]
+    trace = Tracing.Trace()
+    for row in rows:
+        trace.record("queue_wait", time.time() - row['queued_at'], job_id=row['job_id'])
+    results = run_async_modelslab(
+        lambda client: client.gather(
+            trace.timed("submit", client.submit(payload), [row['job_id']], len(json.dumps(payload)))
+            for row, payload in zip(rows, payloads)
+        ),
+        runner,
+        submit=DISPATCH_MAX_CONCURRENCY
+    )
+    # Table writes stay on this thread; the event loop only talks to ModelsLab
+    for row, result in zip(rows, results):
+        with trace.span("table_write", job_id=row['job_id']):
+            if isinstance(result, Exception):
+                print(f"Dispatcher: job {row['job_id']} failed to submit: {result}")
+                row.update(status="failed", error=str(result), updated=datetime.now())
+                update_followers(row)
+            else:
+                apply_submit_response(row, result)
+    trace.flush()
+
+def dispatch_queued_jobs():
+    """
+    Drain the admission queue: whenever in-flight slots and rate-limit tokens allow,
+    submit the next jobs in fair (round-robin per user) order.
+    Exits after POLLER_IDLE_EXIT_SECONDS with an empty queue.
+    """
+    with modelslab_runner(submit=DISPATCH_MAX_CONCURRENCY) as runner:
+        idle_since = time.time()
+        while True:
+            queued = app_tables.try_on_jobs.search(tables.order_by("queued_at"), status="queued")
+            if len(queued) > 0:
+                idle_since = time.time()
+                in_flight = count_in_flight()
+                slots = MAX_IN_FLIGHT_JOBS - in_flight
+                if slots > 0:
+                    picked = fair_order(queued)[:slots]
+                    picked = picked[:take_rate_tokens(rate_bucket_name(), len(picked))]
+                    if picked:
+                        print(f"Dispatcher: submitting {len(picked)} jobs ({in_flight} in flight)")
+                        submit_queued_jobs(picked, runner)
+                        ensure_poller_running()
+            elif time.time() - idle_since > POLLER_IDLE_EXIT_SECONDS:
+                print("Dispatcher: queue empty, exiting")
+                return
+            time.sleep(DISPATCH_TICK_SECONDS)
+
+def poll_pending_jobs():
+    """
+    Poll every in-flight job whose next_poll time has come, once per distinct fetch_url,
+    and write the outcome back to the rows. Exits after POLLER_IDLE_EXIT_SECONDS
+    with nothing in flight; start_try_on and the scheduled watchdog relaunch it.
+    """
+    with modelslab_runner() as runner:
+        idle_since = time.time()
+        while True:
+            in_flight = app_tables.try_on_jobs.search(status="processing", fetch_url=q.not_(None))
+            due = {}
+            any_in_flight = False
+            now = time.time()
+            for row in in_flight:
+                any_in_flight = True
+                started = row['submitting_at'] or row['created'].timestamp()
+                if now - started > JOB_MAX_SECONDS:
+                    fail_job(row, f"Job did not finish within {JOB_MAX_SECONDS} seconds")
+                elif (row['next_poll'] or 0) <= now:
+                    due.setdefault(row['fetch_url'], []).append(row)
+
+            if due:
+                # All due URLs are checked concurrently; rows are updated back on this thread
+                urls = list(due)
+                trace = Tracing.Trace()
+                finished = []
+                results = run_async_modelslab(lambda client: client.gather(
+                    trace.timed("poll", client.fetch(url), [row['job_id'] for row in due[url]]) for url in urls
+                ), runner)
+                for fetch_url, data in zip(urls, results):
+                    if isinstance(data, Exception):
+                        print(f"Poller: failed to check {fetch_url}: {data}")
+                        for row in due[fetch_url]:
+                            errors = (row['fetch_errors'] or 0) + 1
+                            if errors >= POLL_MAX_ERRORS:
+                                fail_job(row, f"Failed to check job status {errors} times: {data}")
+                            else:
+                                row.update(fetch_errors=errors, next_poll=time.time() + POLL_MAX_INTERVAL)
+                        continue
+                    for row in due[fetch_url]:
+                        with trace.span("table_write", job_id=row['job_id']):
+                            record_job_result(row, data)
+                        if row['status'] == "success":
+                            finished.append(row)
+                store_finished_results(finished, trace, runner)
+                trace.flush()
+
+            if any_in_flight:
+                idle_since = time.time()
+            elif time.time() - idle_since > POLLER_IDLE_EXIT_SECONDS:
+                print("Poller: no jobs in flight, exiting")
+                return
+            time.sleep(POLLER_TICK_SECONDS)
+
+def poller_watchdog():
+    """
+    Scheduled safety net: requeues jobs stuck mid-submission and restarts the shared
+    poller and dispatcher if jobs are waiting.
+    """
+    requeue_stalled_submissions()
+    if len(app_tables.try_on_jobs.search(status="queued")) > 0:
+        ensure_task_running('dispatch_queued_jobs')
+    overdue = app_tables.try_on_jobs.search(
+        status="processing",
+        fetch_url=q.not_(None),
+        next_poll=q.less_than(time.time() - POLLER_STALL_SECONDS)
+    )
+    if len(overdue) > 0:
+        ensure_poller_running()
+
+def start_try_on_batch(model_ref, cloth_refs, params=None):
+    """
+    Try one model photo against many garments in a single call.
+    Every garment becomes its own try_on_jobs row under a shared batch_id and goes
+    through the admission queue like any other job. Images sent as Media are uploaded
+    by the upload_batch_images background task, so this call returns straight away;
+    until then the batch's rows have status "uploading".
+    
+    Args:
+        model_ref: The model image, as a ModelsLab URL or a Media object
+        cloth_refs: List of garment images, each a ModelsLab URL or a Media object
+        params: Optional dict with prompt, cloth_type, guidance_scale, num_steps, negative_prompt
+    
+    Returns:
+        {"batch_id": <id>, "total": <number of garments>} - poll get_batch_status for results
+    """
+    email = CallContext().email
+    if not cloth_refs:
+        raise Exception("Please upload at least one cloth image")
+    if len(cloth_refs) > BATCH_MAX_ITEMS:
+        raise Exception(f"A batch can hold at most {BATCH_MAX_ITEMS} garments")
+
+    params = params or {}
+    prompt = params.get("prompt", "")
+    negative_prompt = params.get("negative_prompt", "")
+    cloth_type = params.get("cloth_type", "dresses")
+    guidance_scale = params.get("guidance_scale", 10.0)
+    num_steps = params.get("num_steps", 21)
+
+    refs = [model_ref] + list(cloth_refs)
+    needs_upload = any(not isinstance(ref, str) for ref in refs)
+
+    batch_id = uuid.uuid4().hex
+    rows = []
+    for index, cloth_ref in enumerate(cloth_refs):
+        rows.append(app_tables.try_on_jobs.add_row(
+            job_id=uuid.uuid4().hex,
+            user=email,
+            batch_id=batch_id,
+            batch_index=index,
+            created=datetime.now(),
+            updated=datetime.now(),
+            status="uploading" if needs_upload else "new",
+            user_url=model_ref if isinstance(model_ref, str) else None,
+            cloth_url=cloth_ref if isinstance(cloth_ref, str) else None,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            guidance_scale=guidance_scale,
+            num_steps=num_steps,
+            cloth_type=cloth_type,
+            height=OUTPUT_HEIGHT,
+            width=OUTPUT_WIDTH,
+            seed=DEFAULT_SEED,
+            webhook_token=uuid.uuid4().hex
+        ))
+
+    if needs_upload:
+        anvil.server.launch_background_task('upload_batch_images', batch_id, refs)
+    else:
+        admit_batch_jobs(batch_id, rows)
+
+    return {"batch_id": batch_id, "total": len(cloth_refs)}
+
+def admit_batch_jobs(batch_id, rows):
+    """Answer a batch's rows (whose image URLs are set) from the result cache or queue them."""
+    queued = 0
+    for row in rows:
+        row['params_hash'] = try_on_cache_key(row['user_url'], row['cloth_url'], row['cloth_type'], row['prompt'],
+                                              row['negative_prompt'], row['guidance_scale'], row['num_steps'],
+                                              row['height'], row['width'], row['seed'])
+        cached_url = lookup_result_cache(row['params_hash'])
+        row['cache_hit'] = cached_url is not None
+        record_cache_event("result", row['cache_hit'])
+        if cached_url:
+            row.update(status="success", result_url=cached_url, updated=datetime.now())
+            continue
+        if enqueue_or_attach(row) is None:
+            queued += 1
+
+    if queued:
+        print(f"Batch {batch_id}: queued {queued} of {len(rows)} jobs")
+        ensure_task_running('dispatch_queued_jobs')
+
+def upload_batch_images(batch_id, refs):
+    """
+    Background task for start_try_on_batch: upload the batch's images sent as Media
+    ('refs' is [model_ref] + cloth_refs; URLs are used as-is), then admit its rows.
+    """
+    rows = list(app_tables.try_on_jobs.search(tables.order_by("batch_index"), batch_id=batch_id))
+    try:
+        refs = list(refs)
+        media_positions = [i for i, ref in enumerate(refs) if not isinstance(ref, str)]
+        for i, link in zip(media_positions, upload_many([refs[i] for i in media_positions])):
+            refs[i] = link
+    except Exception as e:
+        print(f"Batch {batch_id}: upload failed: {e}")
+        for row in rows:
+            row.update(status="failed", error=f"Image upload failed: {e}", updated=datetime.now())
+        return
+    for row in rows:
+        row.update(user_url=refs[0], cloth_url=refs[1 + row['batch_index']], status="new")
+    admit_batch_jobs(batch_id, rows)
+
+def get_batch_status(batch_id, have=None):
+    """
+    Report progress of a batch started with start_try_on_batch.
+    Finished images are included for items not listed in 'have' (at most
+    BATCH_IMAGES_PER_STATUS per call), so the client can fill its gallery incrementally.
+    """
+    email = CallContext().email
+    have = set(have or [])
+    items = []
+    done = failed = images_sent = 0
+    for row in app_tables.try_on_jobs.search(tables.order_by("batch_index"), batch_id=batch_id, user=email):
+        if row['status'] == "attached" and settle_attached(row) is None:
+            # Its leader finished or was deleted since the last poll
+            row = app_tables.try_on_jobs.get(job_id=row['job_id'])
+        item = {"index": row['batch_index'], "status": row['status']}
+        if row['status'] == "success":
+            done += 1
+            if row['batch_index'] not in have and images_sent < BATCH_IMAGES_PER_STATUS:
+                item["job_id"] = row['job_id']
+                item["preview"] = get_result_media(row)['preview']
+                images_sent += 1
+        elif row['status'] == "failed":
+            failed += 1
+            item["error"] = row['error'] or "Unknown error"
+        items.append(item)
+    return {
+        "batch_id": batch_id,
+        "total": len(items),
+        "done": done,
+        "failed": failed,
+        "complete": done + failed == len(items),
+        "items": items
+    }
+
+def get_full_result(job_id):
+    """
+    Full-resolution result for one of the user's finished jobs, served from result_media.
+    The Media comes from a table row, so the client only downloads it when it is displayed.
+    """
+    row = CallContext().job(job_id)
+    if row is None or row['status'] != "success":
+        raise Exception("No finished result for this job")
+    return get_result_media(row)['full']
+
+def modelslab_webhook(token, **params):
+    """Receive ModelsLab's completion callback and record it on the job row."""
+    row = app_tables.try_on_jobs.get(webhook_token=token)
+    if row is None:
+        return anvil.server.HttpResponse(404, "Unknown job")
+    data = anvil.server.request.body_json or {}
+    print(f"Webhook for job {row['request_id']}: status={data.get('status')}")
+    record_job_result(row, data)
+    if row['status'] == "success":
+        trace = Tracing.Trace(row['job_id'])
+        try:
+            store_finished_results([row], trace)
+        finally:
+            trace.flush()
+    return {"received": True}
+
+# Optional: Add user-specific data storage
+def save_user_preferences(preferences):
+    user = CallContext().require_user()
+    
+    # Save to user's row in the Users table
+    user['preferences'] = preferences
+
+def get_cleanup_state():
+    """The sweeper's checkpoint row, created on first use."""
+    state = app_tables.cleanup_state.get(name="try_on_jobs")
+    if state is None:
+        state = app_tables.cleanup_state.add_row(name="try_on_jobs", cursor=None, cursor_job_id=None,
+                                                 deleted=0, failed=0)
+    return state
+
+def expired_jobs_page(cutoff_time, cursor, cursor_job_id):
+    """Next CLEANUP_BATCH_SIZE expired jobs after the (created, job_id) cursor, oldest first."""
+    created = q.less_than(cutoff_time)
+    if cursor is not None:
+        # Inclusive, so rows sharing the cursor's timestamp are not skipped; the ones
+        # already visited are dropped below by job_id
+        created = q.all_of(q.greater_than_or_equal_to(cursor), q.less_than(cutoff_time))
+    rows = app_tables.try_on_jobs.search(tables.order_by("created"), tables.order_by("job_id"), created=created)
+    rows = (row for row in rows
+            if cursor is None or row['created'] > cursor or (row['job_id'] or "") > (cursor_job_id or ""))
+    return list(itertools.islice(rows, CLEANUP_BATCH_SIZE))
+
+def delete_jobs_upstream(jobs):
+    """
+    Delete the images of try_on_jobs or catalog_rows rows from ModelsLab concurrently.
+    Returns the rows whose images are gone (or never existed upstream).
+    """
+    # Each upstream request is deleted once, however many rows carry its request_id
+    by_request = {}
+    for job in jobs:
+        if job['request_id']:
+            by_request.setdefault(job['request_id'], []).append(job)
+    # Jobs that never reached ModelsLab (cache hits, attached duplicates, failed submits)
+    # have nothing to delete upstream
+    deletable = [job for job in jobs if not job['request_id']]
+    request_ids = list(by_request)
+    results = run_async_modelslab(
+        lambda client: client.gather(client.delete(request_id) for request_id in request_ids),
+        delete=CLEANUP_DELETE_CONCURRENCY
+    ) if request_ids else []
+    for request_id, result in zip(request_ids, results):
+        if isinstance(result, Exception):
+            print(f"Failed to delete job {request_id}: {result}")
+        elif result.get('status') == 'success':
+            deletable.extend(by_request[request_id])
+        else:
+            print(f"Failed to delete job {request_id}: {result.get('message', result)}")
+    return deletable
+
+def cleanup_old_images():
+    """
+    Scheduled sweeper: delete jobs (and their ModelsLab images) older than CLEANUP_RETENTION_HOURS.
+    Works through the backlog a batch at a time from the checkpoint in cleanup_state, so a
+    large backlog is spread over several runs. Jobs whose upstream delete fails are skipped
+    and retried on the next pass over the table.
+    """
+    cutoff_time = datetime.now() - timedelta(hours=CLEANUP_RETENTION_HOURS)
+    state = get_cleanup_state()
+    started = time.time()
+    swept = failed = 0
+
+    while time.time() - started < CLEANUP_MAX_SECONDS - CLEANUP_SIDE_TABLE_SECONDS:
+        jobs = expired_jobs_page(cutoff_time, state['cursor'], state['cursor_job_id'])
+        if not jobs:
+            # Reached the end of the expired rows: start the next pass from the beginning
+            state.update(cursor=None, cursor_job_id=None)
+            break
+        deletable = delete_jobs_upstream(jobs)
+        cursor, cursor_job_id = jobs[-1]['created'], jobs[-1]['job_id']
+        with tables.Transaction():
+            for job in deletable:
+                job.delete()
+            state.update(
+                cursor=cursor,
+                cursor_job_id=cursor_job_id,
+                deleted=(state['deleted'] or 0) + len(deletable),
+                failed=(state['failed'] or 0) + len(jobs) - len(deletable)
+            )
+        swept += len(deletable)
+        failed += len(jobs) - len(deletable)
+
+    deadline = started + CLEANUP_MAX_SECONDS
+    expire_catalog_rows(cutoff_time, deadline)
+    # Drop uploaded-asset records and upload cache entries whose upstream images have expired.
+    # Whatever is left at the deadline goes on the next run
+    delete_in_pages(app_tables.assets, deadline, created=q.less_than(cutoff_time))
+    delete_in_pages(app_tables.upload_cache, deadline, created=q.less_than(cutoff_time))
+    delete_in_pages(app_tables.result_media, deadline, delete_rows=delete_result_media,
+                    created=q.less_than(cutoff_time))
+    delete_in_pages(app_tables.job_metrics, deadline,
+                    recorded=q.less_than(time.time() - METRICS_RETENTION_HOURS * 3600))
+
+    elapsed = time.time() - started
+    backlog = len(app_tables.try_on_jobs.search(created=q.less_than(cutoff_time)))
+    state.update(
+        last_run=datetime.now(),
+        rows_per_sec=round(swept / elapsed, 2) if elapsed else 0.0,
+        backlog=backlog
+    )
+    print(f"Cleanup: deleted {swept} jobs ({failed} failed) in {elapsed:.1f}s "
+          f"({state['rows_per_sec']} rows/s), backlog {backlog}")
+
+def delete_in_pages(table, deadline, delete_rows=None, **query):
+    """
+    Delete the rows of 'table' matching 'query', CLEANUP_BATCH_SIZE per transaction (or per
+    delete_rows(rows) call), until none are left or 'deadline' passes. Returns the count.
+    """
+    deleted = 0
+    while time.time() < deadline:
+        rows = list(itertools.islice(table.search(**query), CLEANUP_BATCH_SIZE))
+        if not rows:
+            break
+        if delete_rows is not None:
+            delete_rows(rows)
+        else:
+            with tables.Transaction():
+                for row in rows:
+                    row.delete()
+        deleted += len(rows)
+    return deleted
+
+def expire_catalog_rows(cutoff_time, deadline):
+    """
+    Delete the upstream images of catalog rows last updated before 'cutoff_time'.
+    The rows stay, as checkpoints and with any stored output; only request_id is cleared.
+    """
+    cleared = 0
+    while time.time() < deadline:
+        rows = app_tables.catalog_rows.search(request_id=q.not_(None), updated=q.less_than(cutoff_time))
+        rows = list(itertools.islice(rows, CLEANUP_BATCH_SIZE))
+        if not rows:
+            break
+        deleted = delete_jobs_upstream(rows)
+        for row in deleted:
+            row['request_id'] = None
+        cleared += len(deleted)
+        if not deleted:
+            # Every delete failed; leave them for the next run
+            break
+    if cleared:
+        print(f"Cleanup: deleted upstream images of {cleared} catalog rows")
+
+def get_cleanup_stats():
+    """Progress of the cleanup sweeper: throughput of its last run and the remaining backlog (admins only)"""
+    CallContext().require_admin()
+    state = get_cleanup_state()
+    return {
+        "last_run": state['last_run'],
+        "rows_per_sec": state['rows_per_sec'],
+        "backlog": state['backlog'],
+        "deleted": state['deleted'],
+        "failed": state['failed']
+    }
+
+def delete_from_sd(cutoff_time):
+    """Delete images from Stable Diffusion API older than cutoff time"""
+    try:
+        # Get the API endpoint for deletion
+        api_url = "https://stablediffusionapi.com/api/v4/delete"
+        
+        # Call the API to delete old images
+        response = ModelsLabClient.post_json(api_url, {
+            "key": anvil.secrets.get_secret('sd_api_key'),
+            "timestamp": cutoff_time.timestamp()
+        }).json()
+        
+        if response.get('status') == 'success':
+            print(f"Successfully deleted images before {cutoff_time}")
+        else:
+            print(f"Error from SD API: {response.get('error', 'Unknown error')}")
+            
+    except Exception as e:
+        print(f"Failed to delete from SD: {str(e)}")
+        raise
+
+def delete_images_now(job_id):
+    """Immediately delete user images"""
+    try:
+        print(f"Looking for job with job_id: {job_id}")  # Debug
+        
+        # Jobs are only visible to the user who submitted them
+        job = CallContext().job(job_id)
+        print(f"Found job: {job}")  # Debug
+        
+        if job:
+            # Only a job that went upstream itself has images there. Attached duplicates and
+            # result-cache hits point at another job's output, so only their own rows go
+            if job['request_id']:
+                response = ModelsLabClient.post_json(DELETE_API_URL, {
+                    "key": API_KEY,
+                    "request_id": job['request_id']
+                }, op="delete").json()
+                if response.get('status') != 'success':
+                    raise Exception("Failed to delete from ModelsLab")
+                # The upstream image is gone, so the cached result is no longer usable
+                for entry in app_tables.result_cache.search(key=job['params_hash']):
+                    entry.delete()
+            # Duplicates attached to an unfinished job (possibly other users') carry on without it
+            if job['status'] not in ("success", "failed"):
+                new_leader = hand_off_followers(job)
+                if new_leader is not None:
+                    print(f"Job {new_leader['job_id']} takes over from deleted job {job['job_id']}")
+                    ensure_task_running('dispatch_queued_jobs')
+            # The stored copy goes too, unless another job still shows this output
+            others = app_tables.try_on_jobs.search(result_url=job['result_url'], job_id=q.not_(job['job_id']))
+            if job['result_url'] and len(others) == 0:
+                delete_result_media(app_tables.result_media.search(result_url=job['result_url']))
+            # Delete from our database
+            job.delete()
+            print("Job deleted from table")  # Debug
+            return True
+            
+    except Exception as e:
+        print(f"Table operation error: {str(e)}")  # Debug
+        raise
+
+# Create try_on_jobs table if it doesn't exist
+try:
+    app_tables.try_on_jobs
+except AttributeError:
+    app_tables.create_table(
+        'try_on_jobs',
+        [
+            ('job_id', str),
+            ('request_id', str),
+            ('created', datetime),
+            ('updated', datetime),
+            ('user', str),
+            ('status', str),
+            ('user_url', str),
+            ('cloth_url', str),
+            ('prompt', str),
+            ('negative_prompt', str),
+            ('guidance_scale', float),
+            ('num_steps', int),
+            ('cloth_type', str),
+            ('height', int),
+            ('width', int),
+            ('seed', int),
+            ('webhook_token', str),
+            ('fetch_url', str),
+            ('eta', float),
+            ('next_poll', float),
+            ('result_url', str),
+            ('error', str),
+            ('params_hash', str),
+            ('cache_hit', bool),
+            ('batch_id', str),
+            ('batch_index', int),
+            ('queued_at', float),
+            ('leader_job_id', str),
+            ('submitting_at', float),
+            ('fetch_errors', int)
+        ]
+    )
+
+def upload_image(image_type, image_data):
+    print("Store image in database:image_type", image_type)
+    # Uploads happen before any job exists, so their spans are stored without a job_id
+    trace = Tracing.Trace()
+    try:
+        emailID = CallContext().email
+        
+        # Every upload is its own asset row, so concurrent uploads never overwrite each other;
+        # start_try_on picks the newest asset of each kind
+        if image_type == 'user':
+            url = upload_assets(emailID, user_media=image_data, trace=trace)['user_url']
+        else:
+            url = upload_assets(emailID, cloth_media=image_data, trace=trace)['cloth_url']
+        print("Added asset row:", image_type, url)
+        return url
+            
+    except Exception as e:
+        print(f"Error uploading {image_type} image: {str(e)}")
+        raise
+    finally:
+        trace.flush()
+
+def upload_pair(user_media=None, cloth_media=None):
+    """
+    Upload the model and cloth images together, in parallel, in one server call.
+    Either may be None. Returns {"user_url": ..., "cloth_url": ...} for the images given.
+    """
+    email = CallContext().email
+    trace = Tracing.Trace()
+    try:
+        return upload_assets(email, user_media, cloth_media, trace=trace)
+    finally:
+        trace.flush()
+
+def upload_pair_task(user_media, cloth_media):
+    try:
+        return upload_assets(CallContext().email, user_media, cloth_media)
+    except Exception as e:
+        print(f"Error uploading image pair: {str(e)}")
+        raise
+
+def get_latest_user_images():
+    """
+    Links to the logged-in user's most recent model and cloth uploads, for the form's previews.
+    Each kind is one newest-first query that stops at the first row, so this costs the same
+    however many uploads the user has. Returns {"user_url": ..., "cloth_url": ...} (None if missing).
+    """
+    email = CallContext().email
+    latest = {}
+    for kind in ("user", "cloth"):
+        asset = latest_asset(email, kind)
+        latest[f"{kind}_url"] = asset['url'] if asset else None
+    return latest
+
+def get_http_latency_stats():
+    """Per-operation latency counters for ModelsLab calls made by this server process (admins only)"""
+    CallContext().require_admin()
+    return ModelsLabClient.latency_stats()
+
+def get_cache_stats():
+    """Hit/miss counts and hit rate for each server-side cache (admins only)"""
+    CallContext().require_admin()
+    stats = {}
+    for row in app_tables.cache_stats.search():
+        hits, misses = row['hits'] or 0, row['misses'] or 0
+        total = hits + misses
+        stats[row['name']] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0
+        }
+    return stats
+
+def get_stage_latency(window_minutes=60):
+    """p50/p95/p99 duration per pipeline stage over the last 'window_minutes' (admins only)"""
+    CallContext().require_admin()
+    return Tracing.stage_percentiles(time.time() - window_minutes * 60)
+
+def start_background_upload(image_type, image_data):
+    """Start background upload from server side"""
+    anvil.server.launch_background_task('upload_image', image_type, image_data)
+
+def start_background_upload_pair(user_media=None, cloth_media=None):
+    """Start a background upload of whichever of the two images are given and return its task"""
+    return anvil.server.launch_background_task('upload_pair_task', user_media, cloth_media)